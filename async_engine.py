@@ -0,0 +1,134 @@
+################################################################
+# z3c.pypimirror - A PyPI mirroring solution
+# Written by Daniel Kraft, Josip Delic, Gottfried Ganssauge and
+# Andreas Jung
+#
+# Published under the Zope Public License 2.1
+################################################################
+
+"""
+Event loop engine for z3c.pypimirror (--engine async), built on gevent
+"""
+
+import ConfigParser
+import os
+
+try:
+    import gevent
+    import gevent.monkey
+    import gevent.pool
+    import gevent.queue
+    import gevent.threadpool
+except ImportError:
+    gevent = None
+
+
+def available():
+    return gevent is not None
+
+
+def patched():
+    """ True once patch() has made the network modules cooperative """
+    return gevent is not None and gevent.monkey.is_module_patched('socket')
+
+
+def requested(args):
+    """ True if the command line args select the async engine, with
+        --engine or, without it, with "engine = async" in the config
+        file among them
+    """
+    engine = None
+    for position, arg in enumerate(args):
+        if arg.startswith('--engine='):
+            engine = arg[len('--engine='):]
+        elif arg == '--engine':
+            engine = ''.join(args[position + 1:position + 2])
+    if engine is not None:
+        return engine == 'async'
+    for arg in args:
+        if not arg.startswith('-') and _configured(arg):
+            return True
+    return False
+
+
+def _configured(filename):
+    """ True if filename is a config file asking for the async engine """
+    if not os.path.isfile(filename):
+        return False
+    config = ConfigParser.ConfigParser()
+    try:
+        config.read(filename)
+    except ConfigParser.Error:
+        return False
+    return config.defaults().get('engine', '').strip() == 'async'
+
+
+def patch():
+    """ makes socket, ssl, DNS and sleep cooperative, so that a request
+        waiting on the network lets the other packages go on. Threads are
+        left alone: the worker threads aren't used by this engine, and
+        the files are written by real threads (see Engine.blocking).
+
+        Patching is safest before anything imports socket and ssl, which
+        is why mirror.py does it first thing when started as a script
+        with --engine async. Calling it again does no harm.
+    """
+    if gevent is None:
+        raise ImportError("The async engine needs gevent (pip install gevent)")
+    if gevent.monkey.is_module_patched('socket'):
+        return
+    gevent.monkey.patch_all(thread=False, subprocess=False)
+    # urllib3 keeps the idle connections of a host in a queue. A greenlet
+    # waiting there for a free connection has to yield instead of holding
+    # up the loop, which also makes http_pool_maxsize the bound on the
+    # requests in flight per host.
+    from requests.packages.urllib3 import connectionpool
+    connectionpool.ConnectionPool.QueueCls = gevent.queue.LifoQueue
+
+
+class Engine(object):
+    """ Runs one greenlet per package, at most concurrency at a time.
+        Filesystem calls that may block for long are handed to a small
+        pool of writer threads with blocking(), so the event loop keeps
+        serving the network while a file is written, hashed or renamed.
+    """
+    def __init__(self, concurrency=1000, writer_threads=4):
+        patch()
+        self.concurrency = concurrency
+        self.writers = gevent.threadpool.ThreadPool(writer_threads)
+
+    def blocking(self, function, *args, **kwargs):
+        return self.writers.apply(function, args, kwargs)
+
+    def run(self, work, process, on_error):
+        """ calls process(item) for every item handed out by work.get()
+            (a mirror.DelayedQueue). The first exception is passed to
+            on_error(item) and stops handing out items, like a failure
+            in a serial run. Returns the item that failed or None.
+        """
+        pool = gevent.pool.Pool(self.concurrency)
+        failures = []
+
+        def handle(item):
+            try:
+                process(item)
+            except Exception:
+                on_error(item)
+                failures.append(item)
+
+        while not failures:
+            pool.wait_available()
+            item = work.get()
+            if item is None:
+                if not len(pool):
+                    break
+                # a greenlet still running may park its package
+                gevent.sleep(0.05)
+                continue
+            if not failures:
+                pool.spawn(handle, item)
+        pool.join()
+        return failures[0] if failures else None
+
+    def close(self):
+        self.writers.kill()
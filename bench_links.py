@@ -0,0 +1,107 @@
+#! /usr/bin/env python
+################################################################
+# z3c.pypimirror - A PyPI mirroring solution
+# Written by Daniel Kraft, Josip Delic, Gottfried Ganssauge and
+# Andreas Jung
+#
+# Published under the Zope Public License 2.1
+################################################################
+
+"""
+Micro-benchmark: BeautifulSoup anchor parsing vs. linkparser
+
+Compares the old per-package parse path (one BeautifulSoup parse for
+the md5 links and a second one with renderContents() on every anchor
+for the external links) with a single linkparser.anchors() scan.
+
+Usage:
+    python bench_links.py [-n ROUNDS] [page.html | URL ...]
+
+Without arguments a synthetic simple page with 5000 release links is
+used. Large real-world pages are e.g. the simple pages of packages
+with thousands of releases, saved with "curl -o page.html".
+"""
+
+import hashlib
+import optparse
+import time
+
+from BeautifulSoup import BeautifulSoup
+import requests
+
+import linkparser
+
+
+def synthetic_page(links=5000):
+    rows = ['<html><head><title>Links for example</title></head><body><h1>Links for example</h1>']
+    for i in range(links):
+        filename = 'example-%d.%d.%d.tar.gz' % (i // 100, (i // 10) % 10, i % 10)
+        rows.append('<a href="../../packages/source/e/example/%s#md5=%s" rel="internal">%s</a><br/>'
+                    % (filename, hashlib.md5(filename).hexdigest(), filename))
+    rows.append('<a href="http://example.com/" rel="homepage">1.0 home_page</a><br/>')
+    rows.append('<a href="http://example.com/dl/" rel="download">1.0 download_url</a><br/>')
+    # character references in the query, like the DOAP links of legacy PyPI
+    rows.append('<a href="http://example.com/get?name=example&amp;version=1.0" rel="download">1.0 download_url</a><br/>')
+    rows.append('<a href="/pypi?:action=doap&amp;name=example&amp;version=1.0">DOAP</a><br/>')
+    rows.append('</body></html>')
+    return '\n'.join(rows)
+
+
+def beautifulsoup_path(html):
+    """ what Package did before: _fetch_links plus _links_external """
+    hrefs = [link.get("href") for link in BeautifulSoup(html).findAll("a") if link.get("href")]
+    external = set()
+    for link in BeautifulSoup(html).findAll("a"):
+        text = link.renderContents()
+        if (text.endswith("download_url") or text.endswith("home_page")) and link.get("href"):
+            external.add(link.get("href"))
+    return hrefs, external
+
+
+def linkparser_path(html):
+    anchors = linkparser.anchors(html)
+    hrefs = [link.href for link in anchors if link.href]
+    external = set(link.href for link in anchors
+                   if link.href and (link.text.endswith("download_url") or link.text.endswith("home_page")))
+    return hrefs, external
+
+
+def best_of(rounds, func, html):
+    best = None
+    for i in range(rounds):
+        start = time.time()
+        result = func(html)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def main():
+    parser = optparse.OptionParser(usage="usage: %prog [options] [page.html | URL ...]")
+    parser.add_option('-n', '--rounds', dest='rounds', type='int', default=5,
+                      help='Number of rounds, the best one is reported')
+    options, args = parser.parse_args()
+
+    pages = []
+    for arg in args:
+        if arg.startswith('http://') or arg.startswith('https://'):
+            pages.append((arg, requests.get(arg).content))
+        else:
+            pages.append((arg, open(arg, 'rb').read()))
+    if not pages:
+        pages.append(('synthetic (5000 links)', synthetic_page()))
+
+    print "%-40s %8s %8s %12s %12s %8s" % ('page', 'kB', 'anchors', 'soup ms', 'linkparser ms', 'speedup')
+    for name, html in pages:
+        soup_time, (soup_hrefs, soup_external) = best_of(options.rounds, beautifulsoup_path, html)
+        lp_time, (lp_hrefs, lp_external) = best_of(options.rounds, linkparser_path, html)
+        if soup_hrefs != lp_hrefs or soup_external != lp_external:
+            print "WARNING: results differ for %s" % name
+        print "%-40s %8d %8d %12.1f %12.1f %7.1fx" % (name[-40:], len(html) // 1024, len(lp_hrefs),
+                                                    soup_time * 1000, lp_time * 1000,
+                                                    soup_time / max(lp_time, 1e-9))
+
+
+if __name__ == '__main__':
+    main()
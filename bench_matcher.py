@@ -0,0 +1,127 @@
+#! /usr/bin/env python
+################################################################
+# z3c.pypimirror - A PyPI mirroring solution
+# Written by Daniel Kraft, Josip Delic, Gottfried Ganssauge and
+# Andreas Jung
+#
+# Published under the Zope Public License 2.1
+################################################################
+
+"""
+Benchmark: per-call fnmatch/re.compile filtering vs. util.PatternMatcher
+
+Filters the full PyPI package name list with package_matches and a
+generated set of release links with filename_matches, once the way
+PypiPackageList.list and Package.matches used to do it and once with
+the precompiled matcher.
+
+Usage:
+    python bench_matcher.py [--xmlrpc | --names FILE] [--links-per-package N]
+
+FILE is either a pickled list (like packages.p) or a text file with one
+name per line. Without a source 150000 synthetic names are used.
+"""
+
+import glob
+import optparse
+import pickle
+import random
+import re
+import time
+import xmlrpclib
+
+import util
+
+PACKAGE_MATCHES = "zope.* z3c.* plone.* Products.* collective.* five.* django* Django* flask* Flask* pyramid* repoze.* *sql* *SQL*"
+FILENAME_MATCHES = "*.zip *.tgz *.egg *.tar.gz *.tar.bz2 *.whl *.py *.md *.md5 *.xml *.sha1"
+EXTENSIONS = ['.tar.gz', '.zip', '.whl', '.egg', '.exe', '.msi', '.tar.bz2', '.rpm', '.dmg', '.tgz']
+
+
+def old_filter(packages, filter_by):
+    filtered_packages = []
+    for package in packages:
+        if len(filter_by) > 0:
+            if not True in [glob.fnmatch.fnmatch(package, f) for f in filter_by]:
+                continue
+            filtered_packages.append(package)
+        else:
+            filtered_packages.append(package)
+    return filtered_packages
+
+
+def old_matches(filename, filename_matches):
+    for filename_match in filename_matches:
+        if glob.fnmatch.fnmatch(filename, filename_match):
+            return True
+    for filename_match in filename_matches:
+        regex = re.compile(r'\\%s\?' % filename_match)
+        if regex.search(filename):
+            return True
+    return False
+
+
+def load_names(options):
+    if options.xmlrpc:
+        return xmlrpclib.Server('https://pypi.python.org/pypi').list_packages()
+    if options.names:
+        data = open(options.names, 'rb').read()
+        try:
+            return pickle.loads(data)
+        except Exception:
+            return data.split()
+    rand = random.Random(0)
+    prefixes = ['zope.', 'plone.', 'collective.', 'django-', 'flask-', 'py', 'python-', '', '', '', '', '']
+    words = ['app', 'tools', 'sql', 'client', 'api', 'utils', 'core', 'web', 'test', 'data', 'json', 'http']
+    return ['%s%s%s%d' % (rand.choice(prefixes), rand.choice(words), rand.choice(words), i)
+            for i in range(150000)]
+
+
+def generate_links(names, per_package):
+    rand = random.Random(1)
+    links = []
+    for name in names:
+        for i in range(per_package):
+            links.append('https://pypi.python.org/packages/source/%s/%s/%s-%d.%d%s'
+                         % (name[0], name, name, i // 10, i % 10, rand.choice(EXTENSIONS)))
+    return links
+
+
+def timed(label, func, *args):
+    start = time.time()
+    result = func(*args)
+    print "  %-32s %8.2fs" % (label, time.time() - start)
+    return result
+
+
+def main():
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option('--xmlrpc', dest='xmlrpc', action='store_true', default=False,
+                      help='Fetch the package name list from PyPI')
+    parser.add_option('--names', dest='names', action='store', default=None,
+                      help='Pickled list or text file of package names')
+    parser.add_option('--links-per-package', dest='links_per_package', type='int', default=10,
+                      help='Number of release links generated per package')
+    options, args = parser.parse_args()
+
+    names = load_names(options)
+    package_patterns = PACKAGE_MATCHES.split()
+    filename_patterns = FILENAME_MATCHES.split()
+
+    print "package_matches over %d names (%d patterns)" % (len(names), len(package_patterns))
+    old = timed("fnmatch per pattern and name", old_filter, names, package_patterns)
+    matcher = util.PatternMatcher(package_patterns)
+    new = timed("PatternMatcher", lambda: [name for name in names if matcher.match(name)])
+    assert old == new, "package filters disagree"
+    print "  %d names selected" % len(new)
+
+    links = generate_links(names, options.links_per_package)
+    print "filename_matches over %d links (%d patterns)" % (len(links), len(filename_patterns))
+    old = timed("fnmatch + re.compile per link", lambda: [link for link in links if old_matches(link, filename_patterns)])
+    matcher = util.PatternMatcher(filename_patterns)
+    new = timed("PatternMatcher", lambda: [link for link in links if matcher.match_url(link)])
+    assert old == new, "filename filters disagree"
+    print "  %d links selected" % len(new)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,404 @@
+#! /usr/bin/env python
+################################################################
+# z3c.pypimirror - A PyPI mirroring solution
+# Written by Daniel Kraft, Josip Delic, Gottfried Ganssauge and
+# Andreas Jung
+#
+# Published under the Zope Public License 2.1
+################################################################
+
+"""
+Benchmark: mirror a generated package index served from localhost
+
+Starts a stand-in PyPI in a separate process and runs mirror.run()
+against it. The stand-in serves generated simple pages, info pages,
+DOAP records and archives, an XML-RPC endpoint with list_packages and
+the changelog calls, and for every Nth package (--external) a
+download_url page whose links go through a redirect to a
+Content-Disposition download. The mirror logs to the console on
+stderr as usual; the report is written to stdout.
+
+The first pass is an initial fetch into an empty mirror, every further
+pass an update fetch in which --changed percent of the packages show up
+in the changelog. Each pass reports packages/s, MB/s, the requests the
+server saw by type, the peak RSS of the mirror process (every pass
+runs in a process of its own) and the time spent per phase. Phases marked with * are summed over all workers.
+
+Usage:
+    python bench_mirror.py [--packages N] [--files N] [--size KB]
+                           [--external N] [--workers N] [--passes N]
+                           [--engine threads|async] [--layout flat|sharded]
+                           [--changed PERCENT] [--serial] [--keep DIR]
+"""
+
+import BaseHTTPServer
+import SimpleXMLRPCServer
+import SocketServer
+import collections
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import optparse
+import os
+import random
+import resource
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import urllib2
+import urlparse
+import xmlrpclib
+import zipfile
+
+import mirror
+
+
+def normalize(name):
+    return name.lower().replace('_', '-')
+
+
+class Corpus(object):
+    """ The generated packages: pypi hosted sdists listed with their md5
+        on the simple pages and, for every external-th package, zip files
+        only reachable through its download_url page.
+    """
+    def __init__(self, packages, files, size, external, seed=0):
+        rand = random.Random(seed)
+        self.names = ['bench_pkg%05d' % i for i in range(packages)]
+        self.by_normalized = dict((normalize(name), name) for name in self.names)
+        self.files = {}
+        self.hosted = collections.defaultdict(list)
+        self.external = collections.defaultdict(list)
+        for number, name in enumerate(self.names):
+            for i in range(files):
+                filename = '%s-1.%d.tar.gz' % (name, i)
+                data = self._sdist(rand, name, '1.%d' % i, size)
+                self.files[filename] = data
+                self.hosted[name].append((filename, hashlib.md5(data).hexdigest()))
+            if external and number % external == 0:
+                filename = '%s-2.0.zip' % name
+                self.files[filename] = self._zip(rand, name, '2.0', size)
+                self.external[name].append(filename)
+        self.serial = len(self.names)
+
+    def _sdist(self, rand, name, version, size):
+        bio = io.BytesIO()
+        archive = tarfile.open(fileobj=bio, mode='w:gz', compresslevel=1)
+        for member, data in (('PKG-INFO', 'Name: %s\nVersion: %s\n' % (name, version)),
+                             ('data.bin', os.urandom(size))):
+            info = tarfile.TarInfo('%s-%s/%s' % (name, version, member))
+            info.size = len(data)
+            info.mtime = rand.randint(1200000000, 1500000000)
+            archive.addfile(info, io.BytesIO(data))
+        archive.close()
+        return bio.getvalue()
+
+    def _zip(self, rand, name, version, size):
+        bio = io.BytesIO()
+        archive = zipfile.ZipFile(bio, 'w', zipfile.ZIP_STORED)
+        date_time = time.localtime(rand.randint(1200000000, 1500000000))[:6]
+        archive.writestr(zipfile.ZipInfo('%s-%s/data.bin' % (name, version), date_time), os.urandom(size))
+        archive.close()
+        return bio.getvalue()
+
+    def changelog(self, since, percent):
+        """ (name, version, timestamp, action, serial) events for percent
+            of the packages
+        """
+        now = int(time.time())
+        changed = self.names[:len(self.names) * percent // 100]
+        return [(name, '1.0', now, 'add source file %s' % self.hosted[name][0][0], self.serial + i + 1)
+                for i, name in enumerate(changed)]
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # one send per response instead of one per header line, and no
+    # Nagle/delayed ACK stalls on keep-alive connections
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def count(self, kind, size=0):
+        with self.server.lock:
+            self.server.requests['%s %s' % (self.command, kind)] += 1
+            self.server.bytes_sent[kind] += size
+
+    def send(self, code, body='', content_type='text/html', headers=()):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def page(self, kind, body):
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.count(kind + ' (304)')
+            return self.send(304, headers=[('ETag', etag)])
+        self.count(kind, len(body))
+        self.send(200, body, headers=[('ETag', etag)])
+
+    def download(self, kind, filename, headers=()):
+        data = self.server.corpus.files[filename]
+        self.count(kind, len(data) if self.command == 'GET' else 0)
+        headers = [('ETag', '"%s"' % hashlib.md5(data).hexdigest())] + list(headers)
+        self.send(200, data, 'application/octet-stream', headers)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        corpus = self.server.corpus
+        path, query = urlparse.urlsplit(self.path)[2:4]
+        parts = path.strip('/').split('/')
+        if parts == ['pypi'] and query.startswith(':action=doap'):
+            name = urlparse.parse_qs(query)['name'][0]
+            self.count('doap')
+            return self.send(200, '<?xml version="1.0" encoding="UTF-8"?>\n<rdf:RDF><Project>'
+                             '<name>%s</name><shortdesc>Generated package %s</shortdesc>'
+                             '</Project></rdf:RDF>' % (name, name), 'text/xml')
+        if len(parts) == 2 and parts[0] == 'pypi' and parts[1] in corpus.hosted:
+            return self.page('info', '<html><body><a href="/pypi?:action=doap&amp;name=%s&amp;version=1.0">DOAP</a>'
+                             '</body></html>' % parts[1])
+        if len(parts) == 2 and parts[0] == 'simple' and parts[1] in corpus.by_normalized:
+            name = corpus.by_normalized[parts[1]]
+            links = ['<a href="../../packages/source/%s/%s/%s#md5=%s">%s</a><br/>'
+                     % (name[0], name, filename, md5, filename) for filename, md5 in corpus.hosted[name]]
+            if name in corpus.external:
+                links.append('<a href="http://%s/ext/%s/" rel="download">2.0 download_url</a><br/>'
+                             % (self.headers['Host'], name))
+            return self.page('simple', '<html><body>%s</body></html>' % '\n'.join(links))
+        if len(parts) == 5 and parts[:2] == ['packages', 'source'] and parts[4] in corpus.files:
+            return self.download('file', parts[4])
+        if len(parts) == 2 and parts[0] == 'ext' and parts[1] in corpus.external:
+            return self.page('external page', '<html><body>%s</body></html>' % '\n'.join(
+                '<a href="/dl/%s?download=1">%s</a>' % (filename, filename)
+                for filename in corpus.external[parts[1]]))
+        if len(parts) == 2 and parts[0] == 'dl' and parts[1] in corpus.files:
+            self.count('redirect')
+            return self.send(302, headers=[('Location', '/files/%s?sig=%d' % (parts[1], random.randint(0, 1 << 30)))])
+        if len(parts) == 2 and parts[0] == 'files' and parts[1] in corpus.files:
+            return self.download('external file', parts[1],
+                                 [('Content-Disposition', 'attachment; filename="%s"' % parts[1])])
+        if parts == ['_stats']:
+            with self.server.lock:
+                body = json.dumps({'requests': self.server.requests, 'bytes': self.server.bytes_sent})
+                self.server.requests.clear()
+                self.server.bytes_sent.clear()
+            return self.send(200, body, 'application/json')
+        self.count('404')
+        self.send(404, 'Not Found')
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        method = xmlrpclib.loads(data)[1]
+        self.count('xmlrpc ' + method)
+        self.send(200, self.server.dispatcher._marshaled_dispatch(data), 'text/xml')
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, corpus, changed):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.corpus = corpus
+        self.lock = threading.Lock()
+        self.requests = collections.defaultdict(int)
+        self.bytes_sent = collections.defaultdict(int)
+        self.dispatcher = SimpleXMLRPCServer.SimpleXMLRPCDispatcher(allow_none=True, encoding=None)
+        self.dispatcher.register_function(lambda: corpus.names, 'list_packages')
+        self.dispatcher.register_function(lambda since: corpus.changelog(since, changed), 'changelog')
+        self.dispatcher.register_function(lambda: corpus.serial, 'changelog_last_serial')
+        self.dispatcher.register_function(lambda serial: corpus.changelog(serial, changed), 'changelog_since_serial')
+
+
+def serve(options, ready):
+    start = time.time()
+    corpus = Corpus(options.packages, options.files, options.size * 1024, options.external)
+    server = Server(corpus, options.changed)
+    ready.put((server.server_address[1], len(corpus.files), sum(len(data) for data in corpus.files.values()),
+               time.time() - start))
+    server.serve_forever()
+
+
+class PhaseTimer(object):
+    """ wraps methods of the mirror classes to time them """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.elapsed = collections.OrderedDict()
+
+    def instrument(self, cls, attribute, label):
+        original = getattr(cls, attribute)
+        self.elapsed[label] = 0.0
+        timer = self
+
+        def timed(*args, **kw):
+            start = time.time()
+            try:
+                return original(*args, **kw)
+            finally:
+                with timer.lock:
+                    timer.elapsed[label] += time.time() - start
+        setattr(cls, attribute, timed)
+
+    def reset(self):
+        for label in self.elapsed:
+            self.elapsed[label] = 0.0
+
+
+def run_pass(args, phases, results):
+    """ runs in a process of its own: mirror.run(args), reported to
+        results as (packages, seconds, phase timings, peak RSS in kB)
+    """
+    # run() adds its log handlers every time
+    logging.getLogger().handlers = []
+    package_list = []
+    original_mirror = mirror.Mirror.mirror
+
+    def record_list(self, packages, *a, **kw):
+        package_list[:] = packages
+        return original_mirror(self, packages, *a, **kw)
+    mirror.Mirror.mirror = record_list
+    phases.reset()
+    start = time.time()
+    try:
+        mirror.run(args)
+    finally:
+        elapsed = time.time() - start
+        results.put((len(package_list), elapsed, phases.elapsed,
+                     resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def write_config(options, base_url, workdir):
+    config_filename = os.path.join(workdir, 'bench.cfg')
+    with open(config_filename, 'w') as fp:
+        fp.write('[DEFAULT]\n')
+        for key, value in (('pypi_url', base_url),
+                           ('mirror_file_path', os.path.join(workdir, 'mirror')),
+                           ('log_filename', os.path.join(workdir, 'pypimirror.log')),
+                           ('filename_matches', '*.zip *.tar.gz'),
+                           ('create_indexes', True),
+                           ('metrics_textfile', os.path.join(workdir, 'pypimirror.prom')),
+                           ('metrics_interval', 1),
+                           ('workers', options.workers),
+                           ('engine', options.engine),
+                           ('layout', options.layout),
+                           ('rewrite_map_filename', '.rewrite_map'),
+                           ('async_concurrency', options.workers),
+                           ('external_links', options.external > 0),
+                           ('follow_external_index_pages', options.external > 0)):
+            fp.write('%s = %s\n' % (key, value))
+    return config_filename
+
+
+def main():
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option('--packages', dest='packages', type='int', default=200,
+                      help='Number of generated packages')
+    parser.add_option('--files', dest='files', type='int', default=3,
+                      help='Number of sdists per package')
+    parser.add_option('--size', dest='size', type='int', default=64,
+                      help='Payload size of every archive in kB')
+    parser.add_option('--external', dest='external', type='int', default=10,
+                      help='Every Nth package has an external download_url (0: none)')
+    parser.add_option('--workers', dest='workers', type='int', default=1,
+                      help='Number of packages to process concurrently')
+    parser.add_option('--engine', dest='engine', type='choice', default='threads',
+                      choices=['threads', 'async'],
+                      help='Mirror engine; with async, --workers is the number of packages in flight')
+    parser.add_option('--layout', dest='layout', type='choice', default='flat',
+                      choices=['flat', 'sharded'], help='Layout of the mirror directory')
+    parser.add_option('--passes', dest='passes', type='int', default=2,
+                      help='Number of runs, all but the first one are update fetches')
+    parser.add_option('--changed', dest='changed', type='int', default=10,
+                      help='Percent of the packages in the changelog of an update fetch')
+    parser.add_option('--serial', dest='serial', action='store_true', default=False,
+                      help='Use --serial-sync for the update fetches')
+    parser.add_option('--keep', dest='keep', action='store', default=None,
+                      help='Work in this directory and keep it instead of a temporary one')
+    options, args = parser.parse_args()
+
+    ready = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(options, ready))
+    server.daemon = True
+    server.start()
+    port, file_count, corpus_size, generated = ready.get()
+    if options.engine == 'async':
+        # only now, the stand-in PyPI keeps its plain sockets and threads
+        import async_engine
+        async_engine.patch()
+    base_url = 'http://127.0.0.1:%d' % port
+    print "stand-in PyPI at %s: %d packages, %d files, %.1f MB (generated in %.1fs)" % (
+        base_url, options.packages, file_count, corpus_size / 1048576.0, generated)
+
+    workdir = options.keep or tempfile.mkdtemp(prefix='bench_mirror')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    config_filename = write_config(options, base_url, workdir)
+    # the journal and the serial file have to start out empty as well
+    shutil.rmtree(os.path.join(workdir, 'mirror'), ignore_errors=True)
+
+    phases = PhaseTimer()
+    phases.instrument(mirror.PypiPackageList, 'list', 'package list')
+    phases.instrument(mirror.Mirror, 'mirror', 'mirror pass')
+    phases.instrument(mirror.Package, '_fetch_index', '  index pages *')
+    phases.instrument(mirror.Mirror, '_extract_filename', '  filename lookups *')
+    phases.instrument(mirror.Package, 'content_length', '  content-length probes *')
+    phases.instrument(mirror.Package, '_get', '  downloads *')
+    phases.instrument(mirror.MirrorPackage, 'index_html', '  package index pages *')
+    phases.instrument(mirror.Mirror, 'index_html', '  index.html')
+    phases.instrument(mirror.Mirror, 'full_html', '  full.html')
+
+    try:
+        for number in range(options.passes):
+            if number == 0:
+                args = ['-I', config_filename]
+                kind = 'initial fetch'
+            elif options.serial:
+                args = ['-S', '-H', '1', config_filename]
+                kind = 'serial sync'
+            else:
+                args = ['-U', '-H', '1', config_filename]
+                kind = 'update fetch'
+            # each pass in a process of its own, so its peak RSS is its own
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_pass, args=(args, phases, results))
+            process.start()
+            package_count, elapsed, phase_elapsed, peak_rss = results.get()
+            process.join()
+            counters = json.loads(urllib2.urlopen(base_url + '/_stats').read())
+            downloaded = sum(size for kind_, size in counters['bytes'].items() if kind_.endswith('file'))
+            mirror_time = phase_elapsed['mirror pass'] or elapsed
+
+            print
+            print "pass %d (%s, %s engine, %d workers): %d packages in %.2fs" % (
+                number + 1, kind, options.engine, options.workers, package_count, elapsed)
+            print "  %-28s %10.1f" % ('packages/s', package_count / max(mirror_time, 1e-9))
+            print "  %-28s %10.2f" % ('MB/s downloaded', downloaded / 1048576.0 / max(mirror_time, 1e-9))
+            print "  %-28s %10.1f" % ('peak RSS (MB)', peak_rss / 1024.0)
+            print "  requests"
+            for request, count in sorted(counters['requests'].items()):
+                print "    %-26s %10d" % (request, count)
+            print "  phases (s)"
+            for label, seconds in phase_elapsed.items():
+                print "    %-26s %10.2f" % (label, seconds)
+    finally:
+        server.terminate()
+        if not options.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
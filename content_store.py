@@ -0,0 +1,135 @@
+################################################################
+# z3c.pypimirror - A PyPI mirroring solution
+# Written by Daniel Kraft, Josip Delic, Gottfried Ganssauge and
+# Andreas Jung
+#
+# Published under the Zope Public License 2.1
+################################################################
+
+"""
+Content-addressed store that identical archives of the mirror share
+"""
+
+import errno
+import os
+
+
+class DedupeReport(object):
+    """ What a ContentStore.dedupe() pass did """
+    def __init__(self):
+        self.files = 0
+        self.linked = 0
+        self.reclaimed = 0
+        self.orphans = 0
+        self.failed = 0
+
+    def lines(self):
+        return ["Files checked:          %d" % self.files,
+                "Duplicates linked:      %d" % self.linked,
+                "Space reclaimed:        %.1f MB" % (self.reclaimed / 1048576.0),
+                "Orphans removed:        %d" % self.orphans,
+                "Files left alone:       %d" % self.failed]
+
+
+class ContentStore(object):
+    """ Every archive of the mirror, stored once under its md5 as
+        <root>/<md5[:2]>/<md5>. The files in the package directories are
+        hardlinks to these entries, so an archive that shows up under
+        several packages (renamed projects, case variants, re-uploads)
+        takes its space only once, and a link whose md5 is already in
+        the store is linked instead of downloaded.
+
+        The store has to be on the filesystem of the mirror. If a link
+        can't be made (no hardlink support, too many links) the package
+        directory simply keeps its own copy.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def has(self, digest):
+        return bool(digest) and os.path.isfile(self.path(digest))
+
+    def _mkdir(self, path):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _replace_with_link(self, source, path):
+        directory, filename = os.path.split(path)
+        temp_path = os.path.join(directory, ".%s.link" % filename)
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        os.link(source, temp_path)
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            os.unlink(temp_path)
+            raise
+
+    def adopt(self, path, digest):
+        """ makes the file at path share the store entry of digest,
+            adding it to the store if it isn't there yet. Returns the
+            number of bytes this reclaimed.
+        """
+        stored = self.path(digest)
+        if not os.path.exists(stored):
+            self._mkdir(stored)
+            try:
+                os.link(path, stored)
+                return 0
+            except OSError, e:
+                # another worker stored the same bytes meanwhile
+                if e.errno != errno.EEXIST:
+                    raise
+        stat = os.stat(path)
+        stored_stat = os.stat(stored)
+        if (stat.st_dev, stat.st_ino) == (stored_stat.st_dev, stored_stat.st_ino):
+            return 0
+        if stat.st_size != stored_stat.st_size:
+            raise ValueError("%s doesn't match the stored file of the same md5" % path)
+        self._replace_with_link(stored, path)
+        return stat.st_size if stat.st_nlink == 1 else 0
+
+    def link(self, digest, path):
+        """ puts a hardlink to the store entry of digest at path """
+        self._mkdir(path)
+        self._replace_with_link(self.path(digest), path)
+
+    def dedupe(self, files):
+        """ adopts every (path, digest) of files and removes the store
+            entries nothing links to any more. Returns a DedupeReport.
+        """
+        report = DedupeReport()
+        for path, digest in files:
+            report.files += 1
+            try:
+                reclaimed = self.adopt(path, digest)
+            except (OSError, ValueError):
+                report.failed += 1
+                continue
+            if reclaimed:
+                report.linked += 1
+                report.reclaimed += reclaimed
+        report.orphans = self.remove_orphans()
+        return report
+
+    def remove_orphans(self):
+        """ removes the entries no package directory links to """
+        count = 0
+        if not os.path.isdir(self.root):
+            return count
+        for prefix in os.listdir(self.root):
+            directory = os.path.join(self.root, prefix)
+            if not os.path.isdir(directory):
+                continue
+            for digest in os.listdir(directory):
+                path = os.path.join(directory, digest)
+                if os.stat(path).st_nlink == 1:
+                    os.unlink(path)
+                    count += 1
+        return count
@@ -0,0 +1,228 @@
+################################################################
+# z3c.pypimirror - A PyPI mirroring solution
+# Written by Daniel Kraft, Josip Delic, Gottfried Ganssauge and
+# Andreas Jung
+#
+# Published under the Zope Public License 2.1
+################################################################
+
+"""
+Shared, pooled HTTP sessions for z3c.pypimirror
+"""
+
+import email.utils
+import threading
+import time
+import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# responses asking the client to slow down
+THROTTLE_STATUS = (429, 503)
+
+
+class HostThrottled(Exception):
+    """ A host asked to back off for longer than the scheduler is willing
+        to wait in place. The work should be parked for delay seconds and
+        tried again while other hosts are served.
+    """
+    def __init__(self, host, delay):
+        Exception.__init__(self, "%s asked to back off for %.0fs" % (host, delay))
+        self.host = host
+        self.delay = delay
+
+
+def retry_after(response, now=None):
+    """ returns the seconds to wait given by the Retry-After header of
+        response (delta-seconds or an HTTP date) or None
+    """
+    value = response.headers.get('retry-after') if response is not None else None
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(parsed) - (now or time.time()))
+
+
+class _Host(object):
+    """ What the HostScheduler knows about one host """
+    def __init__(self, limit, rate):
+        self.limit = float(limit)
+        self.rate = rate
+        self.in_flight = 0
+        self.next_start = 0.0
+        self.not_before = 0.0
+        self.throttled = 0
+
+
+class HostScheduler(object):
+    """ Admission control per host. Each host gets a concurrency window
+        that is adjusted AIMD-style: it grows by one request per window of
+        fast, successful requests up to max_concurrency and is halved by
+        a response whose headers take longer than slow_latency, an error
+        or a 429/503. A 429/503 also closes the host for its Retry-After
+        time (or an exponential backoff), and requests to it are spaced
+        out to rate per second if the host has a rate cap.
+
+        acquire() waits in place for short delays. When a host is closed
+        for longer than park_after seconds it raises HostThrottled instead,
+        so the caller can park the work and go on with other hosts. The
+        waits use time.sleep, which the async engine makes cooperative.
+    """
+    poll_interval = 0.05
+    min_backoff = 1.0
+    max_backoff = 300.0
+
+    def __init__(self, max_concurrency=10, rate=0, rates=None,
+                 slow_latency=10.0, park_after=5.0):
+        self.max_concurrency = max(1, max_concurrency)
+        self.rate = rate
+        self.rates = dict(rates or {})
+        self.slow_latency = slow_latency
+        self.park_after = park_after
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _host(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            rate = self.rates.get(host, self.rate)
+            state = self._hosts[host] = _Host(self.max_concurrency, rate)
+        return state
+
+    def acquire(self, host):
+        """ waits until a request to host may start """
+        while True:
+            with self._lock:
+                state = self._host(host)
+                now = time.time()
+                if state.not_before - now > self.park_after:
+                    raise HostThrottled(host, state.not_before - now)
+                wait = max(state.not_before, state.next_start) - now
+                if wait <= 0 and state.in_flight < max(1, int(state.limit)):
+                    state.in_flight += 1
+                    if state.rate:
+                        state.next_start = max(now, state.next_start) + 1.0 / state.rate
+                    return
+            time.sleep(min(max(wait, self.poll_interval), self.park_after))
+
+    def release(self, host, latency, status=None, delay=None):
+        """ records the outcome of a request started by acquire(); status
+            is None if it failed without a response, delay the Retry-After
+            time of a throttling response
+        """
+        with self._lock:
+            state = self._host(host)
+            state.in_flight -= 1
+            if status in THROTTLE_STATUS:
+                state.throttled += 1
+                if delay is None:
+                    delay = min(self.max_backoff, self.min_backoff * 2 ** (state.throttled - 1))
+                state.not_before = max(state.not_before, time.time() + delay)
+                state.limit = max(1.0, state.limit / 2)
+            elif status is None or latency > self.slow_latency:
+                state.limit = max(1.0, state.limit / 2)
+            else:
+                state.throttled = 0
+                state.limit = min(self.max_concurrency, state.limit + 1.0 / state.limit)
+
+    def closed_for(self, host):
+        """ returns the seconds until host may be asked again """
+        with self._lock:
+            return max(0.0, self._host(host).not_before - time.time())
+
+    def limits(self):
+        """ returns {host: current concurrency window} """
+        with self._lock:
+            return dict((host, int(state.limit)) for host, state in self._hosts.items())
+
+
+class HttpPool(object):
+    """ A single requests.Session used by every network call of the
+        mirror. The session keeps one urllib3 connection pool per host,
+        so index fetches, HEAD requests and downloads going to the same
+        host reuse open (keep-alive) connections instead of paying for
+        a new TCP and TLS handshake each time. The session may be shared
+        by several worker threads.
+
+        With a HostScheduler every request waits for its host's turn, and
+        a 429/503 is retried up to retries times once the host reopens.
+        A streamed response (stream=True) holds its place in the host's
+        window until it is closed, so the caller has to close() it once
+        the body is read. Its latency is still the time to the headers.
+    """
+    def __init__(self, pool_connections=10, pool_maxsize=10, keep_alive=True,
+                 connect_timeout=30, read_timeout=60, scheduler=None, retries=3):
+        self.timeout = (connect_timeout, read_timeout)
+        self.scheduler = scheduler
+        self.retries = retries
+        self.session = requests.Session()
+        # block instead of opening throw-away connections when all pooled
+        # connections to a host are busy
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize,
+                              pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        if self.scheduler is None:
+            return self.session.request(method, url, **kwargs)
+        host = urlparse.urlsplit(url).netloc.lower()
+        for attempt in range(self.retries + 1):
+            self.scheduler.acquire(host)
+            start = time.time()
+            response = None
+            try:
+                response = self.session.request(method, url, **kwargs)
+            finally:
+                # the time to the response headers, a long download
+                # doesn't make a host slow
+                latency = time.time() - start
+                if response is None or response.status_code in THROTTLE_STATUS or \
+                   not kwargs.get('stream'):
+                    self._release(host, latency, response)
+            if response.status_code not in THROTTLE_STATUS:
+                if kwargs.get('stream'):
+                    self._release_on_close(host, latency, response)
+                return response
+            response.close()
+        raise HostThrottled(host, self.scheduler.closed_for(host))
+
+    def _release(self, host, latency, response):
+        self.scheduler.release(host, latency,
+                               response.status_code if response is not None else None,
+                               retry_after(response))
+
+    def _release_on_close(self, host, latency, response):
+        """ gives the host's place back when response is closed """
+        close = response.close
+        released = []
+
+        def release_and_close():
+            try:
+                close()
+            finally:
+                if not released:
+                    released.append(True)
+                    self._release(host, latency, response)
+        response.close = release_and_close
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', True)
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', False)
+        return self.request('HEAD', url, **kwargs)
+
+    def close(self):
+        self.session.close()
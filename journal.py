@@ -0,0 +1,180 @@
+################################################################
+# z3c.pypimirror - A PyPI mirroring solution
+# Written by Daniel Kraft, Josip Delic, Gottfried Ganssauge and
+# Andreas Jung
+#
+# Published under the Zope Public License 2.1
+################################################################
+
+"""
+Crash-safe record of a mirror run, used to continue it after an
+interruption
+"""
+
+import itertools
+import os
+import threading
+import time
+
+
+def _fsync_dir(path):
+    try:
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+def write_durably(filename, lines):
+    """ writes lines to filename through a temporary file which is
+        fsync'd and renamed into place, so filename holds either the old
+        or the whole new content, also after a crash
+    """
+    temp_filename = filename + ".tmp"
+    fp = open(temp_filename, "w")
+    try:
+        for line in lines:
+            fp.write(line)
+        fp.flush()
+        os.fsync(fp.fileno())
+    finally:
+        fp.close()
+    os.rename(temp_filename, filename)
+    _fsync_dir(filename)
+
+
+class CompletionJournal(object):
+    """ An append-only file holding the package list of the current run
+        followed by one line per completed package:
+
+            begin<TAB>kind<TAB>serial<TAB>count
+            package<TAB>name        (count lines)
+            done<TAB>name           (appended as packages complete)
+
+        The list is written to a temporary file, fsync'd and renamed into
+        place, so a journal either holds a whole list or none. Completion
+        lines are flushed right away and fsync'd in batches; a line torn
+        by a crash is ignored on replay. Since completions are keyed by
+        package name, the order in which packages finish doesn't matter.
+
+        Packages a finished run couldn't handle are kept one per line in
+        filename + ".carry" (see carry_over), for the next package list
+        to take up.
+    """
+    def __init__(self, filename, sync_every=50, sync_interval=5.0):
+        self.filename = filename
+        self._sync_every = sync_every
+        self._sync_interval = sync_interval
+        self._lock = threading.Lock()
+        self._fp = None
+        self._unsynced = 0
+        self._last_sync = time.time()
+        self.kind = None
+        self.serial = None
+        self.packages = None
+        self.completed = set()
+        self.carry_filename = filename + ".carry"
+        self._replay()
+
+    def _replay(self):
+        if not os.path.isfile(self.filename):
+            return
+        packages = []
+        completed = set()
+        header = None
+        with open(self.filename, "r") as fp:
+            for line in fp:
+                if not line.endswith("\n"):
+                    # torn by a crash
+                    break
+                fields = line[:-1].split("\t")
+                if fields[0] == "begin" and len(fields) == 4 and header is None:
+                    header = fields
+                elif fields[0] == "package" and len(fields) == 2:
+                    packages.append(fields[1])
+                elif fields[0] == "done" and len(fields) == 2:
+                    completed.add(fields[1])
+        if header is None or len(packages) != int(header[3]):
+            return
+        self.kind = header[1]
+        self.serial = int(header[2]) if header[2] else None
+        self.packages = packages
+        self.completed = completed.intersection(packages)
+
+    def pending(self, kind):
+        """ returns (serial, packages) of an interrupted run of kind or
+            None if there is none to continue
+        """
+        if self.packages is None or self.kind != kind:
+            return None
+        return self.serial, self.packages
+
+    def carried_over(self):
+        """ returns the packages left to this run by the last one """
+        if not os.path.isfile(self.carry_filename):
+            return []
+        with open(self.carry_filename, "r") as fp:
+            return [line[:-1] for line in fp if line.endswith("\n")]
+
+    def carry_over(self, packages):
+        """ leaves packages to the next run; they are part of its list and
+            with that of its journal once begin() records it
+        """
+        write_durably(self.carry_filename, ("%s\n" % package_name for package_name in packages))
+
+    def begin(self, kind, packages, serial=None):
+        """ starts a new run over packages, dropping the old journal and
+            the packages carried over, which the caller has merged into
+            packages
+        """
+        self.close()
+        header = "begin\t%s\t%s\t%d\n" % (kind, "" if serial is None else serial, len(packages))
+        write_durably(self.filename, itertools.chain(
+            [header], ("package\t%s\n" % package_name for package_name in packages)))
+        if os.path.exists(self.carry_filename):
+            os.unlink(self.carry_filename)
+        self.kind = kind
+        self.serial = serial
+        self.packages = list(packages)
+        self.completed = set()
+
+    def done(self, package_name):
+        """ records package_name as completed """
+        with self._lock:
+            if self.packages is None or package_name in self.completed:
+                return
+            if self._fp is None:
+                self._fp = open(self.filename, "a")
+            self._fp.write("done\t%s\n" % package_name)
+            self._fp.flush()
+            self.completed.add(package_name)
+            self._unsynced += 1
+            if self._unsynced >= self._sync_every or \
+               time.time() - self._last_sync >= self._sync_interval:
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self._fp.fileno())
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def close(self):
+        with self._lock:
+            if self._fp is not None:
+                self._sync()
+                self._fp.close()
+                self._fp = None
+
+    def finish(self):
+        """ the run is complete, nothing is left to continue """
+        self.close()
+        if os.path.exists(self.filename):
+            os.unlink(self.filename)
+            _fsync_dir(self.filename)
+        self.kind = self.serial = self.packages = None
+        self.completed = set()
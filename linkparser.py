@@ -0,0 +1,79 @@
+################################################################
+# z3c.pypimirror - A PyPI mirroring solution
+# Written by Daniel Kraft, Josip Delic, Gottfried Ganssauge and
+# Andreas Jung
+#
+# Published under the Zope Public License 2.1
+################################################################
+
+"""
+Lightweight link extraction for z3c.pypimirror
+
+The pages we read (simple index pages, PyPI info pages and the odd
+external download page) only matter to us for their anchors, so instead
+of building a full BeautifulSoup tree a single regular expression scan
+picks out every <a> element.
+"""
+
+import collections
+import HTMLParser
+import re
+
+_anchor_regex = re.compile(r'<a(?:\s([^>]*))?>(.*?)(?:</a\s*>|(?=<a[\s>])|\Z)', re.I | re.S)
+_href_regex = re.compile(r'''(?:^|\s)href\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''', re.I)
+_tag_regex = re.compile(r'<[^>]*>')
+# decodes character references like &amp; (legacy PyPI pages use it in
+# the query of DOAP and download links), as BeautifulSoup did
+_unescape = HTMLParser.HTMLParser().unescape
+
+
+class Anchor(collections.namedtuple('Anchor', 'url fragment text')):
+    """ An <a> element: the href split into url and #fragment (both None
+        if there is no href) and the text it encloses.
+    """
+    __slots__ = ()
+
+    @property
+    def href(self):
+        if self.fragment:
+            return '%s#%s' % (self.url, self.fragment)
+        return self.url
+
+    @property
+    def hash(self):
+        """ returns (hashname, hexdigest) from a "#md5=..." fragment or
+            (None, None)
+        """
+        if self.fragment:
+            parts = self.fragment.split('=')
+            if len(parts) == 2:
+                return tuple(parts)
+        return (None, None)
+
+
+def anchors(html):
+    """ Reads html once and returns an Anchor for every <a> element """
+    if isinstance(html, str):
+        html = html.decode('utf-8', 'replace')
+    result = []
+    for match in _anchor_regex.finditer(html):
+        url = fragment = None
+        attributes = match.group(1)
+        if attributes:
+            href = _href_regex.search(attributes)
+            if href:
+                url = [value for value in href.groups() if value is not None][0]
+                if '&' in url:
+                    url = _unescape(url)
+                if '#' in url:
+                    url, fragment = url.rsplit('#', 1)
+        text = match.group(2)
+        if '<' in text:
+            text = _tag_regex.sub('', text)
+        result.append(Anchor(url, fragment, text))
+    return result
+
+
+def hrefs(html):
+    """ Returns the non-empty hrefs of all anchors in html """
+    return [anchor.href for anchor in anchors(html) if anchor.href]
@@ -0,0 +1,142 @@
+################################################################
+# z3c.pypimirror - A PyPI mirroring solution
+# Written by Daniel Kraft, Josip Delic, Gottfried Ganssauge and
+# Andreas Jung
+#
+# Published under the Zope Public License 2.1
+################################################################
+
+"""
+Persisted sorted listings the mirror index pages are generated from
+"""
+
+import heapq
+import os
+import tempfile
+import threading
+
+
+def _encode(entry):
+    if isinstance(entry, unicode):
+        return entry.encode('utf-8')
+    return entry
+
+
+def _unique(entries):
+    """ drops repeated entries from a sorted iterable """
+    previous = None
+    for entry in entries:
+        if entry != previous:
+            yield entry
+        previous = entry
+
+
+class SortedListing(object):
+    """ A text file with one entry per line, kept in sorted order. An
+        update merges the changed entries into the existing file in one
+        streaming pass instead of collecting the whole listing again.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+    def exists(self):
+        return os.path.isfile(self.filename)
+
+    def __iter__(self):
+        if not self.exists():
+            return
+        with open(self.filename, "r") as fp:
+            for line in fp:
+                yield line.rstrip("\n")
+
+    def replace(self, entries):
+        """ replaces the listing with entries """
+        return self._write(_unique(sorted(_encode(entry) for entry in entries)))
+
+    def patch(self, add=(), drop=None):
+        """ removes every entry for which drop(entry) is true and merges
+            the entries in add, which may be a SortedSpool. Returns the
+            number of entries.
+        """
+        old = iter(self)
+        if drop is not None:
+            old = (entry for entry in old if not drop(entry))
+        if isinstance(add, SortedSpool):
+            new = add.sorted()
+        else:
+            new = sorted(_encode(entry) for entry in add)
+        return self._write(_unique(heapq.merge(old, new)))
+
+    def _write(self, entries):
+        temp_filename = self.filename + ".tmp"
+        count = 0
+        with open(temp_filename, "w") as fp:
+            for entry in entries:
+                fp.write(entry + "\n")
+                count += 1
+        os.rename(temp_filename, self.filename)
+        return count
+
+
+class SortedSpool(object):
+    """ Collects entries from any number of threads and hands them back
+        sorted, with bounded memory: whenever buffer_size entries have
+        come together they are sorted and written to a temporary run
+        file, and sorted() merges the runs. The run files are written by
+        blocking(function, *args), e.g. on the writer threads of the
+        async engine; the lock isn't held meanwhile.
+    """
+    def __init__(self, directory=None, buffer_size=100000, blocking=None):
+        self.directory = directory
+        self.buffer_size = buffer_size
+        self._blocking = blocking
+        self._buffer = []
+        self._runs = []
+        self._lock = threading.Lock()
+
+    def append(self, entry):
+        with self._lock:
+            self._buffer.append(_encode(entry))
+            if len(self._buffer) < self.buffer_size:
+                return
+            run, self._buffer = self._buffer, []
+        if self._blocking is None:
+            filename = self._spill(run)
+        else:
+            filename = self._blocking(self._spill, run)
+        with self._lock:
+            self._runs.append(filename)
+
+    def extend(self, entries):
+        for entry in entries:
+            self.append(entry)
+
+    def _spill(self, run):
+        """ writes the entries of run sorted to a new run file """
+        run.sort()
+        fd, filename = tempfile.mkstemp(prefix='.spool-', dir=self.directory)
+        with os.fdopen(fd, "w") as fp:
+            for entry in run:
+                fp.write(entry + "\n")
+        return filename
+
+    def __len__(self):
+        return len(self._runs) * self.buffer_size + len(self._buffer)
+
+    def sorted(self):
+        """ yields all entries in sorted order """
+        self._buffer.sort()
+        return heapq.merge(self._buffer, *[self._read(filename) for filename in self._runs])
+
+    def _read(self, filename):
+        with open(filename, "r") as fp:
+            for line in fp:
+                yield line.rstrip("\n")
+
+    def close(self):
+        """ removes the run files """
+        for filename in self._runs:
+            if os.path.exists(filename):
+                os.unlink(filename)
+        self._runs = []
+        self._buffer = []
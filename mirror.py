@@ -55,25 +55,38 @@
 #      creates an HTML table with package name and short description summary from
 #      the package DOAP XML files, if available.
 
+# The async engine (--engine async or engine = async in the config
+# file) has to patch the socket and ssl modules before anything imports
+# them
+import sys
+import async_engine
+if __name__ == '__main__' and async_engine.requested(sys.argv[1:]) and async_engine.available():
+    async_engine.patch()
+
 # Standard Library Modules
+import bisect
+import collections
+import contextlib
 import datetime
 import ConfigParser
+import errno
 try: 
     from hashlib import md5
 except ImportError:
     from md5 import md5
 import glob
-import httplib
+import heapq
+import json
 import linecache
 import optparse
 import os
-import pickle
 import pkg_resources # setuptools
 import re
-import sys
 import shutil
 import socket
+from stat import S_ISDIR
 import tempfile
+import threading
 import time
 import urllib 
 import urllib2
@@ -83,19 +96,51 @@ from xml.dom.minidom import parseString
 import xmlrpclib
 
 # 3rd Party Project Modules
-from BeautifulSoup import BeautifulSoup
-import requests
 import zc.lockfile # https://pypi.python.org/pypi/zc.lockfile/1.1.0
+try:
+    from scandir import scandir # https://pypi.python.org/pypi/scandir, optional
+except ImportError:
+    scandir = None
 
 # Internal Project Modules
+from http_pool import HostScheduler, HostThrottled, HttpPool
+from content_store import ContentStore
+from journal import CompletionJournal, write_durably
+from listing import SortedListing, SortedSpool
+import page_writer
+from page_writer import PageWriter
+import linkparser
+from linkparser import Anchor
 from logger import getLogger
+from statedb import DescriptionIndex, FileIndex, HeadCache, StateDB, ValidatorCache
 import touch_archives
 
 
 
 LOG = None
+PYPI_URL = 'https://pypi.python.org'
+HTTP = HttpPool()
+STATE = None
+VALIDATORS = None
+FILE_INDEX = None
+HEADS = None
+STORE = None
+LAYOUT = 'flat'
+PAGE_ENCODINGS = ()
+JSON_INDEX = False
+DESCRIPTIONS = None
+ENGINE = None
 dev_package_regex = re.compile(r'\ddev[-_]')
 MAX_FILE_CANDIDATES_TO_RETURN = 30
+# the files _save_info() writes next to the archives of a package
+INFO_SUFFIXES = (".html", ".xml")
+# the PEP 691 JSON variant of index.html; v1_json can be mapped to
+# application/vnd.pypi.simple.v1+json by the web server
+JSON_INDEX_FILENAME = "index.v1_json"
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# times a package is parked for a throttling host before it is left
+# to the next run
+MAX_PARKS = 5
 
 
 
@@ -103,7 +148,11 @@ def pypimirror_version():
     """
         returns a version string
     """
-    version = pkg_resources.working_set.by_key["z3c.pypimirror"].version
+    try:
+        version = pkg_resources.working_set.by_key["z3c.pypimirror"].version
+    except KeyError:
+        # running from a checkout
+        return 'z3c.pypimirror'
     return 'z3c.pypimirror/%s' % version
 
 
@@ -119,15 +168,79 @@ def GetExceptionInfo():
 
 
 
-class Stats(object):
-    """ This is just for statistics """
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# the phases Stats keeps timers for, in the order they are reported
+PHASES = (
+    ('index_fetch', 'index, info and DOAP page requests'),
+    ('parse', 'HTML parsing'),
+    ('head', 'HEAD requests (redirects and content-length)'),
+    ('download', 'waiting for download data'),
+    ('hash', 'md5 and archive timestamp computation'),
+    ('disk_write', 'writing downloaded data'),
+    ('touch', 'archive timestamping after download'),
+    ('index_pages', 'writing index pages'),
+)
+
+
+class PhaseStats(object):
+    """ Time, bytes and a latency histogram of one phase """
     def __init__(self):
-        self._found = []
-        self._stored = []
-        self._error_404 = []
-        self._error_invalid_package = []
-        self._error_invalid_url = []
+        self.count = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, seconds, nbytes=0):
+        self.count += 1
+        self.seconds += seconds
+        self.bytes += nbytes
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def cumulative_buckets(self):
+        """ returns [(upper bound, number of observations <= bound)] the
+            way Prometheus histograms count them
+        """
+        total = 0
+        result = []
+        for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), self.buckets):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+def _unicode(value):
+    if isinstance(value, unicode):
+        return value
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return unicode(value)
+
+
+class Stats(object):
+    """ This is just for statistics. Safe to share between worker threads.
+        Only counters and the first error_sample_size errors are kept in
+        memory; with an error_filename every error is written there.
+    """
+    error_sample_size = 20
+
+    def __init__(self, error_filename=None):
+        self._found = 0
+        self._stored = 0
+        self._linked = 0
+        self._error_404 = 0
+        self._error_invalid_package = 0
+        self._error_invalid_url = 0
+        self._error_throttled = 0
+        self._errors = []
+        self._error_file = open(error_filename, "w") if error_filename else None
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self._head_cache_hits = 0
+        self._phases = collections.OrderedDict((name, PhaseStats()) for name, description in PHASES)
         self._starttime = time.time()
+        self._lock = threading.Lock()
 
     def runtime(self):
         runtime = time.time() - self._starttime
@@ -136,134 +249,388 @@ class Stats(object):
         return "%ds" % runtime
 
     def found(self, name):
-        self._found.append(name)
+        with self._lock:
+            self._found += 1
 
     def stored(self, name):
-        self._stored.append(name)
+        with self._lock:
+            self._stored += 1
+
+    def linked(self, name):
+        with self._lock:
+            self._linked += 1
 
     def error_404(self, name):
-        self._error_404.append(name)
+        with self._lock:
+            self._error_404 += 1
+            self._error("404", name)
 
     def error_invalid_package(self, name):
-        self._error_invalid_package.append(name)
+        with self._lock:
+            self._error_invalid_package += 1
+            self._error("invalid package", name)
 
     def error_invalid_url(self, name):
-        self._error_invalid_url.append(name)
+        with self._lock:
+            self._error_invalid_url += 1
+            self._error("invalid url", name)
+
+    def error_throttled(self, name):
+        with self._lock:
+            self._error_throttled += 1
+            self._error("throttled", name)
+
+    def _error(self, kind, detail):
+        # urls and names may be non-ASCII unicode, keep details utf-8
+        if isinstance(detail, tuple):
+            detail = u" ".join(_unicode(part) for part in detail if part)
+        detail = _unicode(detail).encode('utf-8')
+        if len(self._errors) < self.error_sample_size:
+            self._errors.append((kind, detail))
+        if self._error_file is not None:
+            self._error_file.write("%s\t%s\t%s\n" % (time.strftime("%Y-%m-%d %H:%M:%S"), kind, detail))
+
+    def errors(self):
+        """ returns the first error_sample_size (kind, detail) errors """
+        with self._lock:
+            return list(self._errors)
+
+    def close(self):
+        with self._lock:
+            if self._error_file is not None:
+                self._error_file.close()
+                self._error_file = None
+
+    def cache_hit(self, url):
+        with self._lock:
+            self._cache_hits += 1
+
+    def cache_miss(self, url):
+        with self._lock:
+            self._cache_misses += 1
+
+    def head_cache_hit(self, url):
+        with self._lock:
+            self._head_cache_hits += 1
+
+    def record(self, phase, seconds, nbytes=0):
+        """ adds one observation of seconds (and nbytes) to phase """
+        with self._lock:
+            self._phases[phase].add(seconds, nbytes)
+
+    @contextlib.contextmanager
+    def timed(self, phase, nbytes=0):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(phase, time.time() - start, nbytes)
+
+    def counters(self):
+        with self._lock:
+            return collections.OrderedDict((
+                ('found', self._found),
+                ('stored', self._stored),
+                ('linked', self._linked),
+                ('error_404', self._error_404),
+                ('invalid_package', self._error_invalid_package),
+                ('invalid_url', self._error_invalid_url),
+                ('throttled', self._error_throttled),
+                ('cache_hits', self._cache_hits),
+                ('cache_misses', self._cache_misses),
+                ('head_cache_hits', self._head_cache_hits),
+            ))
+
+    def summary(self):
+        """ returns the statistics as a JSON serializable dict """
+        phases = collections.OrderedDict()
+        with self._lock:
+            for name, phase in self._phases.items():
+                phases[name] = collections.OrderedDict((
+                    ('count', phase.count),
+                    ('seconds', round(phase.seconds, 3)),
+                    ('bytes', phase.bytes),
+                    ('mb_per_second', round(phase.bytes / 1048576.0 / phase.seconds, 3) if phase.seconds else 0.0),
+                    ('histogram', collections.OrderedDict(
+                        ("+Inf" if bound == float('inf') else repr(bound), count)
+                        for bound, count in phase.cumulative_buckets())),
+                ))
+        return collections.OrderedDict((
+            ('started', self._starttime),
+            ('runtime_seconds', round(time.time() - self._starttime, 3)),
+            ('counters', self.counters()),
+            ('errors', [collections.OrderedDict((('kind', kind), ('detail', detail)))
+                        for kind, detail in self.errors()]),
+            ('phases', phases),
+        ))
+
+    def write_json(self, filename):
+        _write_atomically(filename, json.dumps(self.summary(), indent=2) + "\n")
+
+    def write_prometheus(self, filename):
+        """ writes the statistics in the Prometheus text format, e.g. for
+            the textfile collector of the node exporter
+        """
+        lines = []
+        lines.append("# HELP pypimirror_run_start_time_seconds Start of the current mirror run.")
+        lines.append("# TYPE pypimirror_run_start_time_seconds gauge")
+        lines.append("pypimirror_run_start_time_seconds %f" % self._starttime)
+        lines.append("# HELP pypimirror_last_update_time_seconds Time this file was written.")
+        lines.append("# TYPE pypimirror_last_update_time_seconds gauge")
+        lines.append("pypimirror_last_update_time_seconds %f" % time.time())
+        lines.append("# HELP pypimirror_events_total Files found, stored and errors of the current run.")
+        lines.append("# TYPE pypimirror_events_total counter")
+        for name, value in self.counters().items():
+            lines.append('pypimirror_events_total{event="%s"} %d' % (name, value))
+        with self._lock:
+            phases = [(name, phase.seconds, phase.bytes, phase.count, phase.cumulative_buckets())
+                      for name, phase in self._phases.items()]
+        lines.append("# HELP pypimirror_phase_bytes_total Bytes transferred or written per phase.")
+        lines.append("# TYPE pypimirror_phase_bytes_total counter")
+        for name, seconds, nbytes, count, buckets in phases:
+            lines.append('pypimirror_phase_bytes_total{phase="%s"} %d' % (name, nbytes))
+        lines.append("# HELP pypimirror_phase_duration_seconds Duration of the operations of a phase.")
+        lines.append("# TYPE pypimirror_phase_duration_seconds histogram")
+        for name, seconds, nbytes, count, buckets in phases:
+            for bound, observations in buckets:
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                lines.append('pypimirror_phase_duration_seconds_bucket{phase="%s",le="%s"} %d' % (name, le, observations))
+            lines.append('pypimirror_phase_duration_seconds_sum{phase="%s"} %f' % (name, seconds))
+            lines.append('pypimirror_phase_duration_seconds_count{phase="%s"} %d' % (name, count))
+        _write_atomically(filename, "\n".join(lines) + "\n")
 
     def getStats(self):
         ret = []
         ret.append("Statistics")
         ret.append("----------")
-        ret.append("Found (cached):         %d" % len(self._found))
-        ret.append("Stored (downloaded):    %d" % len(self._stored))
-        ret.append("Not found (404):        %d" % len(self._error_404))
-        ret.append("Invalid packages:       %d" % len(self._error_invalid_package))
-        ret.append("Invalid URLs:           %d" % len(self._error_invalid_url))
+        ret.append("Found (cached):         %d" % self._found)
+        ret.append("Stored (downloaded):    %d" % self._stored)
+        ret.append("Linked (content store): %d" % self._linked)
+        ret.append("Not found (404):        %d" % self._error_404)
+        ret.append("Invalid packages:       %d" % self._error_invalid_package)
+        ret.append("Invalid URLs:           %d" % self._error_invalid_url)
+        ret.append("Left to next run (429): %d" % self._error_throttled)
+        ret.append("Index cache hits (304): %d" % self._cache_hits)
+        ret.append("Index cache misses:     %d" % self._cache_misses)
+        ret.append("HEAD cache hits:        %d" % self._head_cache_hits)
         ret.append("Runtime:                %s" % self.runtime())
+        ret.append("Time per phase (summed over all workers)")
+        for name, description in PHASES:
+            phase = self._phases[name]
+            line = "  %-44s %9.1fs %8d x" % (description + ":", phase.seconds, phase.count)
+            if phase.bytes:
+                line += " %10.1f MB" % (phase.bytes / 1048576.0)
+            ret.append(line)
+        if self._errors:
+            ret.append("First errors:")
+            for kind, detail in self._errors:
+                ret.append("  %s: %s" % (kind, detail))
         return ret
 
 
+def blocking(function, *args, **kwargs):
+    """ calls function, on a writer thread when the async engine runs """
+    if ENGINE is None:
+        return function(*args, **kwargs)
+    return ENGINE.blocking(function, *args, **kwargs)
+
+
+def normalize_name(package_name):
+    """ the PEP 503 normalized form of package_name """
+    return re.sub(r"[-_.]+", "-", package_name).lower()
+
+
+def shard(package_name):
+    """ the directory of the sharded layout package_name lives in: the
+        first two hex digits of the md5 of its normalized name. Names
+        are spread evenly over the 256 shards, unlike by their first
+        characters, where "py", "dj" or "fl" hold thousands each.
+    """
+    normalized = normalize_name(package_name)
+    if isinstance(normalized, unicode):
+        normalized = normalized.encode('utf-8')
+    return md5(normalized).hexdigest()[:2]
+
+
+def package_dir(base_path, package_name):
+    """ the directory of package_name in the mirror at base_path. The
+        sharded layout keeps it in a subdirectory named by shard(), so
+        that no directory gets too big.
+    """
+    if LAYOUT == 'sharded':
+        return os.path.join(base_path, shard(package_name), package_name)
+    return os.path.join(base_path, package_name)
+
+
+def make_package_dir(path):
+    """ creates a package directory (and its shard) if it's missing """
+    try:
+        os.mkdir(path)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            os.makedirs(path)
+        # otherwise like "File exists"
+
+
+def head_content_length(response):
+    """ the Content-Length of a HEAD response, 0 if there is none """
+    ct = response.headers.get('content-length')
+    if ct is None:
+        return 0
+    return long(ct)
+
+
+def page(filename):
+    """ opens the index page filename for writing, see PageWriter """
+    return PageWriter(filename, PAGE_ENCODINGS)
+
+
+def _write_atomically(filename, content):
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, "w") as fp:
+        fp.write(content)
+    os.rename(temp_filename, filename)
+
+
+class StatsExporter(object):
+    """ Writes the Prometheus textfile of a Stats every interval seconds
+        while a run is going on
+    """
+    def __init__(self, stats, filename, interval=60):
+        self.stats = stats
+        self.filename = filename
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stats-exporter')
+        self._thread.daemon = True
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.stats.write_prometheus(self.filename)
+            except (IOError, OSError), e:
+                LOG.warn("Could not write %s (%s)" % (self.filename, e))
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """ stops the thread and writes the final figures """
+        self._stopped.set()
+        self._thread.join()
+        self.stats.write_prometheus(self.filename)
+
+
 
 class PypiPackageList(object):
     """
         This fetches and represents a package list
     """
-    def __init__(self, pypi_xmlrpc_url='http://pypi.python.org/pypi'):
-        self._pypi_xmlrpc_url = pypi_xmlrpc_url
+    def __init__(self, pypi_xmlrpc_url=None):
+        self._pypi_xmlrpc_url = pypi_xmlrpc_url or PYPI_URL + '/pypi'
+        # changelog serial the returned list brings the mirror up to, to
+        # be saved with write_last_serial() once it has been mirrored
+        self.serial = None
+
+    def list(self, filter_by=None, incremental=False, fetch_since_days=7, fetch_since_hours=0, serial_filename=None, journal=None):
+        """ With serial_filename an incremental list holds the packages
+            changed since the serial stored in that file. If there is no
+            stored serial yet, the fetch_since_* time window is used.
+            If the journal holds the list of an interrupted run of the
+            same kind, that list is returned so the run is continued;
+            otherwise the packages the journal carries over from the last
+            run are added and the new list is recorded in the journal.
+        """
+        kind = ("serial" if serial_filename else "incremental") if incremental else "initial"
+        if journal is not None:
+            pending = journal.pending(kind)
+            if pending is not None:
+                self.serial, packages = pending
+                print time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()) + (" " * 12) + "Continuing interrupted run: " + \
+                      "%d packages, %d already done" % (len(packages), len(journal.completed))
+                return packages
 
-    def list(self, filter_by=None, incremental=False, fetch_since_days=7, fetch_since_hours=0):
+        last_serial = read_last_serial(serial_filename) if incremental and serial_filename else None
         print time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()) + (" " * 12) + "Building package list for updates. "+ ("Incremental" if incremental else "Non-Incremental") + \
-              (" Fetch since hours=" + str(fetch_since_hours) if fetch_since_hours > 0 else " fetch since days=" + str(fetch_since_days))
+              (" since serial=" + str(last_serial) if last_serial is not None else
+               " Fetch since hours=" + str(fetch_since_hours) if fetch_since_hours > 0 else " fetch since days=" + str(fetch_since_days))
+        self.serial = None
         
         socket.setdefaulttimeout(30)
         ##########################################
         # Debug using a single package
         #return ['Custom-Interactive-Console']  
         ##########################################
-        #return ['Custom-Interactive-Console']  
-        use_pickled_index=True
-        strListPickled = 'packages.p'
         server = xmlrpclib.Server(self._pypi_xmlrpc_url)
-        if use_pickled_index and os.path.isfile(strListPickled):
-            print "Loading packages.p"
-            packages = pickle.load(open(strListPickled, 'rb'))
-            #return packages[0:2]
-        else:
-            try:
-                packages = server.list_packages()
-                if use_pickled_index:
-                    pickle.dump(packages, open(strListPickled, 'wb'))
-                else:
-                    if os.path.isfile(strListPickled):
-                        os.remove(strListPickled)
-            except Exception, e:
-                raise PackageError("General error: %s" % e)
-           
+        try:
+            if serial_filename:
+                # taken first, so the next serial based update also
+                # covers changes made while the list is mirrored
+                self.serial = server.changelog_last_serial()
+            packages = server.list_packages()
+        except Exception, e:
+            raise PackageError("General error: %s" % e)
 
         print "   Initial Package Count  = " + str(len(packages))
         
-        ##########################################
-        # Return all available packages
-        #return packages
-        ##########################################
-        #return packages
-
-        # There is a problem where this program halts with no exception
-        # so I am not sure where the code is failing yet.
-        # This is a workaround until I locate that problem
-        pkg_start_pos = 0
-        
-        # This first case handles a non-incremental update:
-        if not incremental and not use_pickled_index:
-            packages = list(set(packages))
-            packages = packages[pkg_start_pos:]
-            return packages
-
-        # This second case handles the incremental update:
-        # If the script finds the incremental package list already
-        # built it returns that so that 1) the list does not have to 
-        # be rebuilt and 2) you can pickup from the point of failure
-        # by changing pkg_start_pos to the last good package number
-        # shown in the previous run. You can also do a resume after
-        # a CTRL-C
-        if incremental:
-            strIncrementalPickled = "incremental_" + strListPickled
-            if use_pickled_index and os.path.isfile(strIncrementalPickled):
-                print "Loading " + strIncrementalPickled
-                packages = pickle.load(open(strIncrementalPickled, 'rb'))
-                packages = packages[pkg_start_pos:]
-                print "Incremental Package Count = " + str(len(packages))
-                return packages
-        
-        filtered_packages = []
-        for package in packages:
-            if len(filter_by) > 0:
-                if not True in [glob.fnmatch.fnmatch(package, f) for f in filter_by]:
-                    continue
-                filtered_packages.append(package)
-            else:
-                filtered_packages.append(package)
+        if filter_by:
+            if not isinstance(filter_by, util.PatternMatcher):
+                filter_by = util.PatternMatcher(filter_by)
+            filtered_packages = [package for package in packages if filter_by.match(package)]
+        else:
+            filtered_packages = list(packages)
         print "   Filtered Package Count = " + str(len(filtered_packages))
          
         if incremental:
-            if fetch_since_hours > 0:
-               changelog = server.changelog(int(time.time() - fetch_since_hours*3600))
+            self.serial = None
+            if last_serial is not None:
+               # (name, version, timestamp, action, serial) of every event
+               # after last_serial
+               changelog = server.changelog_since_serial(last_serial)
+               self.serial = max([last_serial] + [tp[4] for tp in changelog])
             else:
-               changelog = server.changelog(int(time.time() - fetch_since_days*24*3600))
-            changed_packages = [tp[0] for tp in changelog 
-                                if 'file' in tp[3]]
-            changed_packages = [package for package in changed_packages if package in filtered_packages]
-            changed_packages = list(set(changed_packages))
-            print "Incremental Package Count = " + str(len(changed_packages))
-            if use_pickled_index:
-                pickle.dump(changed_packages, open("incremental_" + strListPickled, 'wb'))
-            return changed_packages
+               if serial_filename:
+                  # first serial based run, take the serial before reading
+                  # the changelog so no event falls between the two
+                  self.serial = server.changelog_last_serial()
+               if fetch_since_hours > 0:
+                  changelog = server.changelog(int(time.time() - fetch_since_hours*3600))
+               else:
+                  changelog = server.changelog(int(time.time() - fetch_since_days*24*3600))
+            filtered_packages = set(filtered_packages)
+            changed_packages = set([tp[0] for tp in changelog 
+                                    if 'file' in tp[3] and tp[0] in filtered_packages])
+            packages = list(changed_packages)
+            print "Incremental Package Count = " + str(len(packages))
         else:
-            filtered_packages = list(set(filtered_packages))
-            print "Filtered Package Count(2) = " + str(len(filtered_packages))
-            return filtered_packages
+            packages = list(set(filtered_packages))
+            print "Filtered Package Count(2) = " + str(len(packages))
+        if journal is not None:
+            carried = set(journal.carried_over()).difference(packages)
+            if carried:
+                # left over by the last run, e.g. because their host kept
+                # throttling them
+                packages.extend(sorted(carried))
+                print "Carried over Package Count = " + str(len(carried))
+            journal.begin(kind, packages, self.serial)
+        return packages
     
 
+def read_last_serial(filename):
+    """ returns the changelog serial stored in filename or None """
+    try:
+        return int(open(filename, "r").read().strip())
+    except (IOError, ValueError):
+        return None
+
+
+def write_last_serial(filename, serial):
+    """ stores serial in filename, replacing the old file only once the
+        new one is safely on disk
+    """
+    write_durably(filename, ["%d\n" % serial])
+
+
 class PackageError(Exception):
     try:
         raise Exception
@@ -271,13 +638,26 @@ class PackageError(Exception):
        print e.message
     pass
 
+
+def doap_shortdesc(raw_xml):
+    """ returns the <shortdesc> of a DOAP record or "" """
+    if 'shortdesc' not in raw_xml:
+        return ""
+    try:
+        return parseString(raw_xml).getElementsByTagName('shortdesc')[0].firstChild.data
+    except:
+        return ""
+
+
+
 class Package(object):
     """
         This handles the list of versions and fetches the
         files
     """
-    def __init__(self, package_name, pypi_base_url="https://pypi.python.org/simple"):
+    def __init__(self, package_name, pypi_base_url=None, stats=None):
         self._links_cache = None
+        self.stats = stats or Stats()
 
         if not util.isASCII(package_name):
             raise PackageError("%s is not a valid package name." % package_name)
@@ -288,7 +668,7 @@ class Package(object):
             raise PackageError("%s is not a valid package name." % package_name)
 
         self.name = package_name
-        self._pypi_base_url = pypi_base_url
+        self._pypi_base_url = pypi_base_url or PYPI_URL + '/simple'
 
     def url(self, filename=None, splittag=True):
         if filename:
@@ -304,87 +684,133 @@ class Package(object):
         return url
 
     def _fetch_index(self):
+       """ fetches the info page, DOAP record and simple index of the
+           package. Returns the anchors of the simple index as a list
+           of linkparser.Anchor.
+       """
        #print "in _fetch_index"
        try:
-           r = requests.get('https://pypi.python.org/pypi/' + self.name + '/')
-           raw_html = r.content          
-           
-           
+           info_url = PYPI_URL + '/pypi/' + self.name + '/'
+           info_response, cached = self._get_if_modified(info_url)
+           # a 304 means info.html and the DOAP record are up to date
+           if info_response is not None:
+               self._save_info(info_response.content)
+               self._remember(info_url, info_response, None)
+       except HostThrottled:
+           raise
+       except Exception, e:
+           raise PackageError('Generic error: %s' % e)
+       #print "in _fetch_index"
+       try:
+           r, cached = self._get_if_modified(self.url())
+           if r is not None:
+               anchors = self._anchors(r.content)
+               self._remember(self.url(), r, anchors)
+           else:
+               anchors = [Anchor(*anchor) for anchor in cached]
+       except urllib2.HTTPError, v:
+           if '404' in str(v):             # sigh
+               raise PackageError("Package not available (404): %s" % self.url())
+           raise PackageError("Package not available (unknown reason): %s" % self.url())
+       except urllib2.URLError, v:
+           raise PackageError("URL Error: %s " % self.url())
+       except (PackageError, HostThrottled):
+           raise
+       except Exception, e:
+           raise PackageError('Generic error: %s' % e)
+       return anchors
+
+    def _save_info(self, raw_html):
+           anchors = self._anchors(raw_html)
            if raw_html.find('Index of Packages') > -1:
               try:
-                 soup = BeautifulSoup(raw_html)
-                 links = soup.findAll("a")
-                 for link in links:
-                    href = link.get("href")
+                 for link in anchors:
+                    href = link.href
                     if href != None and href.find('/pypi/' + self.name + '/') > -1:
-                       r = requests.get('https://pypi.python.org' + href)
+                       r = self._get_page(PYPI_URL + href)
                        raw_html = r.content 
+                       anchors = self._anchors(raw_html)
                        break
+              except HostThrottled:
+                 raise
               except:
                  LOG.debug("HTML download error " + href)
               
            
            # Save the raw_html
-           if not os.path.exists(local_pypi_path + self.name):
-               os.mkdir(local_pypi_path + self.name)
-           html_info_filename = os.path.join(local_pypi_path, self.name, "info.html")
-           html_orig_info_filename = os.path.join(local_pypi_path, self.name, "info_orig.html")
-           if not os.path.isfile(html_orig_info_filename) and os.path.isfile(html_info_filename):
-              os.rename(html_info_filename, html_orig_info_filename)
-           if (os.path.isfile(html_info_filename) and len(raw_html) >= os.path.getsize(html_info_filename)) or not os.path.isfile(html_info_filename):
-               open(html_info_filename, "wb").write(raw_html)
-               LOG.debug("HTML info file written " + html_info_filename)
+           package_path = package_dir(local_pypi_path, self.name)
+           blocking(self._write_info_html, package_path, raw_html)
 
            # Save Current XML DOAP Record   
            try:
-             soup = BeautifulSoup(raw_html)
-             links = soup.findAll("a")
-             for link in links:
-                href = link.get("href")
+             for link in anchors:
+                href = link.href
                 if href != None and href.find('action=doap') > -1:
                    xml_filename = href.replace('/pypi?:action=doap&name=', '').replace('&version=', '-') + '.xml'
-                   xml_info_filename = os.path.join(local_pypi_path, self.name, xml_filename)
-                   if not os.path.isfile(xml_info_filename):
-                      r = requests.get('https://pypi.python.org' + href.replace(' ', '%20')) 
+                   xml_info_filename = os.path.join(package_path, xml_filename)
+                   if not blocking(os.path.isfile, xml_info_filename):
+                      r = self._get_page(PYPI_URL + href.replace(' ', '%20')) 
                       raw_xml = r.content
-                      open(xml_info_filename, "wb").write(raw_xml)
+                      blocking(_write_atomically, xml_info_filename, raw_xml)
                       LOG.debug("XML info file written " + xml_info_filename)
-                      dom3 = parseString(raw_xml)
-                      LOG.debug('*' * 3 + ' ' + dom3.getElementsByTagName('shortdesc')[0].firstChild.data + ' ' + '*' * 3)                     
+                      shortdesc = doap_shortdesc(raw_xml)
+                      if DESCRIPTIONS:
+                         DESCRIPTIONS.store(self.name, xml_filename, shortdesc)
+                      LOG.debug('*' * 3 + ' ' + shortdesc + ' ' + '*' * 3)                     
                    break
+           except HostThrottled:
+             raise
            except:
              LOG.debug("XML download error " + href)
-               
-               
-       except Exception, e:
-           raise PackageError('Generic error: %s' % e)
-       #print "in _fetch_index"
-       try:
-           r = requests.get(self.url())
-           html = r.content
-       except urllib2.HTTPError, v:
-           if '404' in str(v):             # sigh
-               raise PackageError("Package not available (404): %s" % self.url())
-           raise PackageError("Package not available (unknown reason): %s" % self.url())
-       except urllib2.URLError, v:
-           raise PackageError("URL Error: %s " % self.url())
-       except Exception, e:
-           raise PackageError('Generic error: %s' % e)
-       return html
+
+    def _write_info_html(self, package_path, raw_html):
+           make_package_dir(package_path)
+           html_info_filename = os.path.join(package_path, "info.html")
+           html_orig_info_filename = os.path.join(package_path, "info_orig.html")
+           if not os.path.isfile(html_orig_info_filename) and os.path.isfile(html_info_filename):
+              os.rename(html_info_filename, html_orig_info_filename)
+           if (os.path.isfile(html_info_filename) and len(raw_html) >= os.path.getsize(html_info_filename)) or not os.path.isfile(html_info_filename):
+               open(html_info_filename, "wb").write(raw_html)
+               LOG.debug("HTML info file written " + html_info_filename)
+
+    def _get_if_modified(self, url):
+        """ GETs url with the validators known from an earlier run.
+            Returns (response, None) or, if the server answered 304 Not
+            Modified, (None, data) with the data remembered for url.
+        """
+        cached = VALIDATORS.lookup(url) if VALIDATORS else None
+        headers = cached.request_headers() if cached else {}
+        r = self._get_page(url, headers=headers)
+        if cached and r.status_code == 304:
+            self.stats.cache_hit(url)
+            return None, cached.data
+        if VALIDATORS:
+            self.stats.cache_miss(url)
+        return r, None
+
+    def _remember(self, url, response, data):
+        if VALIDATORS:
+            VALIDATORS.store(url, response, data)
+
+    def _get_page(self, url, **kwargs):
+        """ HTTP.get for the pages we parse, timed as index_fetch """
+        start = time.time()
+        r = HTTP.get(url, **kwargs)
+        self.stats.record('index_fetch', time.time() - start, len(r.content))
+        return r
+
+    def _anchors(self, html):
+        with self.stats.timed('parse'):
+            return linkparser.anchors(html)
 
     def _fetch_links(self, html):
         try:
-            soup = BeautifulSoup(html)
+            with self.stats.timed('parse'):
+                return linkparser.hrefs(html)
         except Exception, e:
             raise PackageError("HTML parse error: %s" % e)
-        links = []
-        for link in soup.findAll("a"):
-            href = link.get("href")
-            if href:
-                links.append(href)
-        return links
-
-    def _links_external(self, html, filename_matches=None, follow_external_index_pages=False):
+
+    def _links_external(self, anchors, filename_matches=None, follow_external_index_pages=False):
         """ pypi has external "download_url"s. We try to get anything
             from there too. This is really ugly and I'm not sure if there's
             a sane way.  The download_url directs either to a website which
@@ -393,19 +819,17 @@ class Package(object):
 
         #print "in _links_external"
         download_links = set()
-        soup = BeautifulSoup(html)
-        links = soup.findAll("a")
-        for link in links:
-            if link.renderContents().endswith("download_url"):
+        for link in anchors:
+            if link.text.endswith("download_url"):
                 # we have a download_url!! Yeah.
-                url = link.get("href")
+                url = link.href
                 if not url:
                     continue
                 download_links.add(url)
 
-            if link.renderContents().endswith("home_page"):
+            if link.text.endswith("home_page"):
                 # we have a download_url!! Yeah.
-                url = link.get("href")
+                url = link.href
                 if not url:
                     continue
                 download_links.add(url)
@@ -424,7 +848,9 @@ class Package(object):
 
                 if follow_external_index_pages:
                     try:
-                        r = requests.get(link)
+                        r = self._get_page(link)
+                    except HostThrottled:
+                        raise
                     except Exception, e:
                         LOG.warn('Error downloading %s (%s)' % (link, e))
                         continue
@@ -476,16 +902,11 @@ class Package(object):
             mirroring
         """
         #print "in _links"
-        remote_index_html = self._fetch_index()
-        for link in self._fetch_links(remote_index_html):
+        anchors = self._fetch_index()
+        for link in anchors:
             # then handle "normal" packages in pypi.
-            (url, hash) = urllib.splittag(link)
-            if not hash:
-                continue
-            try:
-                (hashname, hash) = hash.split("=")
-            except ValueError:
-                continue
+            url = link.url
+            (hashname, hash) = link.hash
             if not hashname == "md5":
                 continue
 
@@ -496,23 +917,17 @@ class Package(object):
             yield (url, hash)
 
         if external_links:
-            for link in self._links_external(remote_index_html, filename_matches, follow_external_index_pages):
+            for link in self._links_external(anchors, filename_matches, follow_external_index_pages):
                 yield (link, None)
 
     def matches(self, filename, filename_matches):
+        """ filename_matches is a util.PatternMatcher (a plain list of
+            patterns is compiled on every call)
+        """
         #print "in matches"
-        for filename_match in filename_matches:
-            if glob.fnmatch.fnmatch(filename, filename_match):
-                return True
-
-        # perhaps 'filename' is part of a query string, so 
-        # try a regex match 
-        for filename_match in filename_matches:
-            regex = re.compile(r'\\%s\?' % filename_match)
-            if regex.search(filename):
-                return True
-        
-        return False
+        if not isinstance(filename_matches, util.PatternMatcher):
+            filename_matches = util.PatternMatcher(filename_matches)
+        return filename_matches.match_url(filename)
 
     def ls(self, filename_matches=None, external_links=False, follow_external_index_pages=True):
         #print "in _ls"
@@ -522,33 +937,95 @@ class Package(object):
         #print "out of ls"
         return [(link[0], os.path.basename(link[0]), link[1]) for link in links]
 
-    def _get(self, url, filename, md5_hex=None):
-      """ fetches a file and checks for the md5_hex if given
+    def _get(self, mirror_package, url, filename, md5_hex=None):
+      """ streams a file into mirror_package and checks for the md5_hex
+          if given. The data is written in chunks to a hidden .part file
+          which only replaces the real file once the md5 matches. A .part
+          file left over by an interrupted download is continued with a
+          Range request. Returns the number of bytes stored.
       """
       # since some time in Feb 2009 PyPI uses different and relative URLs
       if url.startswith('../../packages'):
-         url = 'https://pypi.python.org/' + url[6:]
+         url = PYPI_URL + '/' + url[6:]
          #print "url is --> ", url
          #print "filename is -->", filename
+      partial = blocking(mirror_package.partial, filename)
+      headers = blocking(partial.resume_headers, url, md5_hex)
+      # seconds spent waiting for the server, hashing and writing
+      waited = hashing = writing = 0.0
+      received = 0
+      mark = time.time()
+      try:
+         r = HTTP.get(url, stream=True, headers=headers)
+         if headers and r.status_code == 416:
+            # the server can't continue the .part file, start over
+            r.close()
+            blocking(partial.discard)
+            headers = {}
+            r = HTTP.get(url, stream=True)
+      except HostThrottled:
+         raise
+      except Exception as e:
+         raise PackageError("Couldn't download (%s): %s" % (e, url))
+      waited += time.time() - mark
+      checksum = md5()
+      timer = touch_archives.archive_timer(filename)
+      consumers = [c for c in (checksum, timer) if c is not None]
       try:
-         r = requests.get(url)
          if 'text/html' in r.headers['content-type']:
              raise PackageError("File no longer exists. HTML returned rather than package.")
-         data = r.content
+         if headers and blocking(partial.continued_by, r):
+             resumed = blocking(getattr, partial, "size")
+             LOG.debug("Resuming download at %d bytes: %s" % (resumed, url))
+             with self.stats.timed('hash', resumed):
+                 fp = blocking(partial.resume, *consumers)
+         elif r.status_code == 206:
+             blocking(partial.discard)
+             raise PackageError("Partial content that doesn't continue the .part file")
+         else:
+             fp = blocking(partial.start, url, md5_hex, r)
+         try:
+             mark = time.time()
+             for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                 received += len(chunk)
+                 now = time.time()
+                 waited += now - mark
+                 blocking(fp.write, chunk)
+                 mark = time.time()
+                 writing += mark - now
+                 for consumer in consumers:
+                     consumer.update(chunk)
+                 now, mark = mark, time.time()
+                 hashing += mark - now
+         finally:
+             blocking(fp.close)
+      except HostThrottled:
+         raise
       except Exception as e:
+         # the .part file is kept so the next attempt can continue it
          raise PackageError("Couldn't download (%s): %s" % (e, url))
+      finally:
+         r.close()
+         self.stats.record('download', waited, received)
+         self.stats.record('disk_write', writing, received)
+         self.stats.record('hash', hashing, received)
       if md5_hex:
          # check for md5 checksum
-         data_md5 = md5(data).hexdigest()
+         data_md5 = checksum.hexdigest()
          if md5_hex != data_md5:
+            blocking(partial.discard)
             raise PackageError("MD5 sum does not match: %s / %s on package %s" % (md5_hex, data_md5, url))
-      return data
+      size = blocking(getattr, partial, "size")
+      mtime = timer.newest_time() if timer is not None else None
+      blocking(mirror_package.commit, filename, partial, md5_hex, url=url,
+               digest=checksum.hexdigest(), mtime=mtime, stats=self.stats)
+      return size
       
-    def get(self, link):
-        """ link is a tuple of url, md5_hex
+    def get(self, link, mirror_package):
+        """ link is a tuple of url, filename, md5_hex
         """
         #print "in get"
-        return self._get(*link)
+        return self._get(mirror_package, *link)
 
     def content_length(self, link):
 
@@ -556,22 +1033,72 @@ class Package(object):
         # HEAD request in order to save bandwidth
 
         #print "in content_length"
+        cached = HEADS.lookup(link) if HEADS else None
+        if cached is not None and cached.content_length is not None:
+            self.stats.head_cache_hit(link)
+            return cached.content_length
+        length = 0
+        status = None
         try:
-            r = requests.head(link)
-            ct = r.headers['content-length']
-            if ct is not None:
-                ct = long(ct)
-                return ct
+            with self.stats.timed('head'):
+                r = HTTP.head(link)
+            status = r.status_code
+            length = head_content_length(r)
+        except HostThrottled:
+            raise
         except Exception, e:
             LOG.warn('Could not obtain content-length through a HEAD request from %s (%s)' % (link, e))
+        if HEADS:
+            HEADS.store_length(link, length, status)
+        return length
+
+class DelayedQueue(object):
+    """ The packages of a run, shared by the workers. A package whose
+        host asked to back off is put back with put_later() and handed
+        out again once its delay has passed; meanwhile the workers go on
+        with the other packages.
+    """
+    def __init__(self, items=()):
+        self._ready = collections.deque(items)
+        self._delayed = []
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def put_later(self, item, delay):
+        with self._lock:
+            self._count += 1
+            heapq.heappush(self._delayed, (time.time() + delay, self._count, item))
+
+    def get(self):
+        """ returns the next item, waiting for a delayed one if nothing
+            else is left, or None when the queue is empty
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                if self._delayed and self._delayed[0][0] <= now:
+                    return heapq.heappop(self._delayed)[2]
+                if self._ready:
+                    return self._ready.popleft()
+                if not self._delayed:
+                    return None
+                wait = self._delayed[0][0] - now
+            time.sleep(min(wait, 1.0))
+
+    def clear(self):
+        with self._lock:
+            self._ready.clear()
+            self._delayed = []
 
-        return 0
 
 class Mirror(object):
     """ This represents the whole mirror directory
     """
-    def __init__(self, base_path):
+    def __init__(self, base_path, rewrite_map=None, rewrite_map_format="apache"):
         self.base_path = base_path
+        # file mapping the PEP 503 names to the package directories
+        self.rewrite_map = rewrite_map
+        self.rewrite_map_format = rewrite_map_format
         self.mkdir()
 
     def mkdir(self):
@@ -591,76 +1118,228 @@ class Mirror(object):
         return
 
     def ls(self):
-        filenames = []
-        for filename in os.listdir(self.base_path):
-            if os.path.isdir(os.path.join(self.base_path, filename)):
-                filenames.append(filename)
+        """ the sorted package names, from the package registry. Only a
+            mirror without a registry yet is scanned (see scan).
+        """
+        listing = self.package_listing()
+        if not listing.exists():
+            self.rebuild_registry()
+        return iter(listing)
+
+    def _dirs(self, path):
+        # hidden directories like the content store aren't packages
+        return [filename for filename in os.listdir(path)
+                if not filename.startswith(".") and os.path.isdir(os.path.join(path, filename))]
+
+    def scan(self):
+        """ the sorted names of the package directories on disk """
+        if LAYOUT == 'sharded':
+            filenames = []
+            for prefix in self._dirs(self.base_path):
+                filenames.extend(self._dirs(os.path.join(self.base_path, prefix)))
+        else:
+            filenames = self._dirs(self.base_path)
         filenames.sort()
         return filenames
 
+    def register(self, package_names):
+        """ adds package_names to the package registry """
+        listing = self.package_listing()
+        if not listing.exists():
+            return self.rebuild_registry()
+        count = listing.patch(package_names)
+        self.write_rewrite_map()
+        return count
+
+    def rebuild_registry(self):
+        """ writes the package registry from a scan of the mirror """
+        count = self.package_listing().replace(self.scan())
+        self.write_rewrite_map()
+        return count
+
+    def write_rewrite_map(self):
+        """ writes the rewrite map, which maps the PEP 503 normalized
+            name of every package to its directory relative to the mirror
+            root. With the "apache" format it is a RewriteMap txt: file,
+            e.g. for
+                RewriteMap pypi txt:/path/to/map
+                RewriteRule ^/simple/([^/]+)/(.*)$ /simple/${pypi:$1|$1}/$2
+            with "nginx" it can be included into a map block, e.g.
+                map $project $project_dir { include /path/to/map; }
+            Of package names that normalize alike the first one is used.
+        """
+        if not self.rewrite_map:
+            return
+        line = "%s %s;\n" if self.rewrite_map_format == "nginx" else "%s %s\n"
+        temp_filename = self.rewrite_map + ".tmp"
+        seen = set()
+        with open(temp_filename, "w") as fp:
+            for package_name in self.package_listing():
+                normalized = normalize_name(package_name)
+                if normalized in seen:
+                    continue
+                seen.add(normalized)
+                fp.write(line % (normalized, self._relative_path(package_name)))
+        os.rename(temp_filename, self.rewrite_map)
+
+    def _relative_path(self, package_name):
+        return os.path.relpath(package_dir(self.base_path, package_name), self.base_path)
+
     def _html_link(self, filename):
-        return '<a href="%s/">%s</a>' % (filename, filename)
+        return '<a href="%s/">%s</a>' % (self._relative_path(filename), filename)
 
-    def _index_html(self):
+    def rebuild_file_index(self, file_index):
+        """ fills file_index from the files in the mirror directory. The
+            md5 is taken from the .md5 sidecars; files without one are
+            hashed when they are first checked. Known source urls are kept.
+        """
+        count = 0
+        for package_name in self.ls():
+            mirror_package = MirrorPackage(self, package_name)
+            known = file_index.package_files(package_name)
+            file_index.clear(package_name)
+            manifest = mirror_package.manifest
+            for filename in mirror_package.ls():
+                url = known[filename].url if filename in known else None
+                stat = manifest.stat(filename)
+                file_index.record(package_name, filename, stat.st_size,
+                                  manifest.sidecar_md5(filename), stat.st_mtime, url)
+                count += 1
+        file_index.db.commit()
+        return count
+
+    def dedupe(self, store):
+        """ moves every file whose md5 is known (from its sidecar or the
+            FILE_INDEX) into the content store and links duplicates to
+            the stored copy. Returns a content_store.DedupeReport.
+        """
+        def files():
+            for package_name in self.ls():
+                mirror_package = MirrorPackage(self, package_name)
+                known = FILE_INDEX.package_files(package_name) if FILE_INDEX else {}
+                for filename in mirror_package.ls():
+                    digest = mirror_package.manifest.sidecar_md5(filename)
+                    if not digest and filename in known:
+                        digest = known[filename].md5
+                    if digest:
+                        yield mirror_package.path(filename), digest
+        return store.dedupe(files())
+
+    def package_listing(self):
+        """ sorted listing of the package directories, see index_html """
+        return SortedListing(os.path.join(self.base_path, ".packages"))
+
+    def full_listing(self):
+        """ sorted "filename<TAB>package" listing, see full_html """
+        return SortedListing(os.path.join(self.base_path, ".full"))
+
+    def _write_index_html(self, fp, listing):
         header = "<html><head><title>PyPI Mirror</title></head><body>"
         header += "<h1>PyPI Mirror</h1><h2>Last update: " + \
                   datetime.datetime.utcnow().strftime("%c UTC")+"</h2>\n"
-        _ls = self.ls()
-        links = "<br />\n".join([self._html_link(link) for link in _ls])
-        generator = "<p class='footer'>Generated by %s; %d packages mirrored. For details see the <a href='http://www.coactivate.org/projects/pypi-mirroring'>z3c.pypimirror project page.</a></p>" % (pypimirror_version(), len(_ls))
+        fp.write(header + "\n")
+        count = 0
+        for link in listing:
+            if count:
+                fp.write("<br />\n")
+            fp.write(self._html_link(link))
+            count += 1
+        generator = "<p class='footer'>Generated by %s; %d packages mirrored. For details see the <a href='http://www.coactivate.org/projects/pypi-mirroring'>z3c.pypimirror project page.</a></p>" % (pypimirror_version(), count)
         footer = "</body></html>\n"
-        return "\n".join((header, links, generator, footer))
+        fp.write("\n" + generator + "\n" + footer)
 
     def index_html(self):
-        content = self._index_html()
-        open(os.path.join(self.base_path, "index.html"), "wb").write(content)
-
-    def full_html(self, full_list):
+        """ writes index.html (and with JSON_INDEX its PEP 691 JSON
+            variant) from the package registry, entry by entry
+        """
+        with page(os.path.join(self.base_path, "index.html")) as fp:
+            self._write_index_html(fp, self.ls())
+        if JSON_INDEX:
+            with page(os.path.join(self.base_path, JSON_INDEX_FILENAME)) as fp:
+                self._write_index_json(fp, self.ls())
+
+    def package_indexes(self, base_url):
+        """ rewrites the index pages of every package in the registry,
+            e.g. to add the JSON pages to the packages of an existing
+            mirror. Returns the number of packages.
+        """
+        count = 0
+        for package_name in self.ls():
+            if os.path.isdir(package_dir(self.base_path, package_name)):
+                self.package(package_name).index_html(base_url)
+                count += 1
+        return count
+
+    def _write_index_json(self, fp, listing):
+        fp.write('{"meta": {"api-version": "1.0"}, "projects": [')
+        separator = "\n"
+        for package_name in listing:
+            fp.write(separator + json.dumps({"name": package_name}))
+            separator = ",\n"
+        fp.write("\n]}\n")
+
+    def full_html(self, full_list, packages=()):
+        """ full_list holds "filename<TAB>package" entries for the files
+            of packages seen in this run (a list or a SortedSpool). They
+            replace the entries of those packages in the full listing,
+            which full.html is then written from.
+        """
+        packages = set(packages)
+        listing = self.full_listing()
+        listing.patch(full_list, drop=lambda entry: entry.split("\t", 1)[-1] in packages)
         header = "<html><head><title>PyPI Mirror</title></head><body>"  
         header += "<h1>PyPi Mirror</h1><h2>Last update: " + \
                   time.strftime("%c %Z")+"</h2>\n"
         footer = "</body></html>\n"
-        fp = file(os.path.join(self.base_path, "full.html"), "wb")
-        fp.write(header)
-        fp.write("<br />\n".join(full_list))
-        fp.write(footer)
-        fp.close()
+        with page(os.path.join(self.base_path, "full.html")) as fp:
+            fp.write(header)
+            separator = ""
+            for entry in listing:
+                filename = entry.split("\t", 1)[0]
+                fp.write('%s<a href="%s">%s</a>' % (separator, filename, filename))
+                separator = "<br />\n"
+            fp.write(footer)
         
 
+    def _scan_description(self, package_name):
+        """ reads the short description from the newest DOAP file in the
+            package directory, returns (DOAP filename, description)
+        """
+        search_path = os.path.join(package_dir(self.base_path, package_name), '*.xml')
+        xml_files = filter(os.path.isfile, glob.glob(search_path))
+        if not xml_files:
+            return None, ""
+        xml_info_filename = max(xml_files, key=os.path.getmtime)
+        with open(xml_info_filename, "r") as xml_file:
+            return os.path.basename(xml_info_filename), doap_shortdesc(xml_file.read())
+
     def expanded_index_html(self):
+        """ writes index_expanded.html with the short descriptions from
+            DESCRIPTIONS; only packages it doesn't know yet are scanned
+            for DOAP files (and added to it)
+        """
         header = "<html><head><title>PyPI Mirror</title></head><body>\n"
         header += "<h1>PyPI Mirror</h1><h2>Last update: " + \
             datetime.datetime.utcnow().strftime("%c UTC")+"</h2>\n"
-        _ls = self.ls()
-        total_links = len(_ls)
-        with open(os.path.join(self.base_path, "index_expanded.html"), "wb") as expanded_html_file:
+        total_links = sum(1 for link in self.ls())
+        with page(os.path.join(self.base_path, "index_expanded.html")) as expanded_html_file:
             expanded_html_file.write(header.encode('utf-8'))
             expanded_html_file.write('<table border="1">')
-            for link_counter, link in enumerate(_ls):
+            for link_counter, link in enumerate(self.ls()):
                 link_counter += 1.0
                 progress = int(link_counter / total_links * 100)
                 sys.stdout.write('\rGenerating Expanded Index [{0}] {1}% ({2}/{3})'.format(('#'*(progress/10)).ljust(10), progress, int(link_counter), total_links))
-                search_path = os.path.join(local_pypi_path, link, '*.xml')
-                xml_files = filter(os.path.isfile, glob.glob(search_path))
-                xml_files.sort(key=lambda x: os.path.getmtime(x))
-                link_desc = ""
-                if len(xml_files) > 0:
-                    xml_info_filename = xml_files[-1]
-                    if os.path.isfile(xml_info_filename):
-                        raw_xml = ""
-                        with open(xml_info_filename, "r") as xml_file:
-                            raw_xml = xml_file.read()
-                            if 'shortdesc' in raw_xml:
-                                try:
-                                    dom3 = parseString(raw_xml)
-                                    link_desc = dom3.getElementsByTagName('shortdesc')[0].firstChild.data
-                                    link_desc = link_desc.replace('<', '&lt;').replace('>', '&gt;')
-                                except:
-                                    pass
-        
-                expanded_html_file.write(("<tr><td>" + self._html_link(link).replace('/">', '/index.html">') + "</td><td>" + link_desc + "</td></tr>\n").encode('utf-8'))
+                link_desc = DESCRIPTIONS.lookup(link) if DESCRIPTIONS else None
+                if link_desc is None:
+                    doap, link_desc = self._scan_description(link)
+                    if DESCRIPTIONS:
+                        DESCRIPTIONS.store(link, doap, link_desc)
+                if isinstance(link_desc, unicode):
+                    link_desc = link_desc.encode('utf-8')
+                link_desc = link_desc.replace('<', '&lt;').replace('>', '&gt;')
+                expanded_html_file.write("<tr><td>" + self._html_link(link).replace('/">', '/index.html">') + "</td><td>" + link_desc + "</td></tr>\n")
             expanded_html_file.write("</table>\n")
-            expanded_html_file.write("<p class='footer'>Generated by %s; %d packages mirrored. For details see the <a href='http://www.coactivate.org/projects/pypi-mirroring'>z3c.pypimirror project page.</a></p>\n" % (pypimirror_version(), len(_ls)))
+            expanded_html_file.write("<p class='footer'>Generated by %s; %d packages mirrored. For details see the <a href='http://www.coactivate.org/projects/pypi-mirroring'>z3c.pypimirror project page.</a></p>\n" % (pypimirror_version(), total_links))
             expanded_html_file.write("</body></html>\n")
         print "\n"
 
@@ -674,134 +1353,299 @@ class Mirror(object):
                create_indexes, 
                external_links, 
                follow_external_index_pages, 
-               base_url):
+               base_url,
+               workers=1,
+               journal=None,
+               stats_json=None,
+               metrics_textfile=None,
+               metrics_interval=60,
+               error_filename=None):
+        """ mirrors the packages in package_list. Packages the journal
+            records as completed (by an interrupted earlier attempt of
+            this run) are skipped, the others are recorded in it as they
+            complete. The run's Stats are written to stats_json as JSON
+            at the end and, every metrics_interval seconds while the run
+            goes on, to metrics_textfile in the Prometheus text format.
+            Every error of the run is written to error_filename.
+
+            Returns the packages left to the next run because their host
+            kept throttling them. They are carried over in the journal,
+            so the next package list takes them up again.
+        """
+        total_pkg_count = len(package_list)
+        completed = set(journal.completed) if journal is not None else set()
+        remaining = [package_name for package_name in package_list if package_name not in completed]
+        done_before = total_pkg_count - len(remaining)
+        if done_before:
+            LOG.debug('Skipping %d packages completed before the interruption' % done_before)
+        stats = Stats(error_filename)
+        # "filename<TAB>package" of every file seen, spooled to disk in
+        # sorted runs; shared by all workers like handled and changed,
+        # whose append and add are atomic
+        full_list = SortedSpool(self.base_path, blocking=blocking)
+        # names of the packages that had at least one file to handle
+        handled = []
+        # names of the packages that got new files
+        changed = set()
+        # names of the packages that have a directory in the mirror
+        present = []
+        # names of the packages parked more than MAX_PARKS times
+        dropped = []
+
+        exporter = None
+        if metrics_textfile:
+            exporter = StatsExporter(stats, metrics_textfile, metrics_interval)
+            exporter.start()
+        try:
+            def process(position, package_name):
+                LOG.debug('Processing package %s (%s of %s)' % (package_name, str(done_before + position), str(total_pkg_count)))
+                filename, mirror_package = self._mirror_package(package_name, filename_matches, verbose,
+                                                                external_links, follow_external_index_pages,
+                                                                base_url, stats, full_list, changed)
+                if journal is not None:
+                    blocking(journal.done, package_name)
+                if mirror_package is not None:
+                    present.append(package_name)
+                if filename != None:
+                    handled.append(package_name)
+# Disabled cleanup for now since it does not deal with the changelog() implementation
+#               if cleanup:
+#                   mirror_package.cleanup(links, verbose)
+                    if create_indexes and (package_name in changed or
+                                           not mirror_package.manifest.has("index.html") or
+                                           JSON_INDEX and not mirror_package.manifest.has(JSON_INDEX_FILENAME)):
+                        with stats.timed('index_pages'):
+                            blocking(mirror_package.index_html, base_url)
+
+            work = DelayedQueue((position + 1, package_name, 0)
+                                for position, package_name in enumerate(remaining))
+
+            def attempt(item):
+                position, package_name, parks = item
+                try:
+                    process(position, package_name)
+                except HostThrottled, e:
+                    if parks >= MAX_PARKS:
+                        LOG.info("Leaving package %s to the next run: %s" % (package_name, e))
+                        stats.error_throttled((package_name, str(e)))
+                        dropped.append(package_name)
+                    else:
+                        LOG.debug("Parking package %s for %.0fs: %s" % (package_name, e.delay, e))
+                        work.put_later((position, package_name, parks + 1), e.delay)
+
+            if ENGINE is not None:
+                failed = ENGINE.run(work, attempt,
+                                    lambda item: LOG.debug(GetExceptionInfo()))
+                if failed is not None:
+                    raise PackageError("Engine stopped on package %s" % failed[1])
+            elif workers > 1:
+                self._run_workers(work, attempt, min(workers, len(remaining)))
+            else:
+                while True:
+                    item = work.get()
+                    if item is None:
+                        break
+                    attempt(item)
+#        if cleanup:
+#            self.cleanup(package_list, verbose)
 
-        cur_pkg_counter = 0
-        filename = None
-        
-        pkg_ctr_filename = "pkg_ctr.txt"        
-        if os.path.isfile(pkg_ctr_filename):
-            cur_pkg_counter = int(open(pkg_ctr_filename, "r").readline()) 
-            package_list = package_list[cur_pkg_counter-1:]
+            if done_before and create_indexes:
+                # the full listing wasn't patched for the packages completed
+                # before the interruption, take their files from disk
+                for package_name in package_list:
+                    if package_name in completed and os.path.isdir(package_dir(self.base_path, package_name)):
+                        handled.append(package_name)
+                        full_list.extend("%s\t%s" % (filename, package_name)
+                                         for filename in self.package(package_name).archives()
+                                         if not filename_matches or filename_matches.match(filename))
+
+            # The pass has completed successfully, nothing is left to
+            # continue but the packages left to the next run
+            if journal is not None:
+                if dropped:
+                    LOG.info("Carrying %d packages over to the next run" % len(dropped))
+                    journal.carry_over(dropped)
+                journal.finish()
         
-        total_pkg_count = len(package_list)+cur_pkg_counter
-        stats = Stats()
-        full_list = []
-        for package_name in package_list:
+            with stats.timed('index_pages'):
+                self.register(present + [package_name for package_name in completed
+                                         if os.path.isdir(package_dir(self.base_path, package_name))])
+
+            # Generate the local HTML pages
+            if create_indexes and handled:
+                with stats.timed('index_pages'):
+                    self.index_html()
+                with stats.timed('index_pages'):
+                    self.full_html(full_list, handled)
+
+            if STATE:
+                STATE.commit()
+
+            for line in stats.getStats():
+                LOG.debug(line)
+            return dropped
+        finally:
+            full_list.close()
+            if exporter is not None:
+                exporter.stop()
+            if stats_json:
+                stats.write_json(stats_json)
+            stats.close()
+
+    def _run_workers(self, work, process, workers):
+        """ Feeds the items of the DelayedQueue work to a pool of worker
+            threads. Each worker handles one package at a time from start
+            to end.
+        """
+        failures = []
 
-            cur_pkg_counter += 1
-            LOG.debug('Processing package %s (%s of %s)' % (package_name, str(cur_pkg_counter), str(total_pkg_count)))
+        def worker():
+            while True:
+                item = work.get()
+                if item is None:
+                    return
+                try:
+                    process(item)
+                except Exception:
+                    LOG.debug(GetExceptionInfo())
+                    failures.append(item[1])
+                    # stop handing out packages at the first failure,
+                    # like a serial run
+                    work.clear()
+                    return
+
+        threads = [threading.Thread(target=worker, name='mirror-worker-%d' % i)
+                   for i in range(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        # join with a timeout so that CTRL-C still reaches the main thread
+        while [thread for thread in threads if thread.is_alive()]:
+            for thread in threads:
+                thread.join(0.5)
+        if failures:
+            raise PackageError("Worker stopped on package %s" % failures[0])
+
+    def _mirror_package(self, package_name, filename_matches, verbose,
+                        external_links, follow_external_index_pages,
+                        base_url, stats, full_list, changed):
+        """ Mirrors all files of a single package. Returns the name of
+            the last file handled or None if there was nothing to do,
+            along with the MirrorPackage (None if the package failed).
+        """
+        filename = None
 
-            try:
-                package = Package(package_name)
-            except PackageError, v:
-                stats.error_invalid_package(package_name)
-                LOG.debug("Package is not valid.")
-                continue
+        try:
+            package = Package(package_name, stats=stats)
+        except PackageError, v:
+            stats.error_invalid_package(package_name)
+            LOG.debug("Package is not valid.")
+            return None, None
 
+        try:
+            links = package.ls(filename_matches, external_links, 
+                               follow_external_index_pages)
+        except PackageError, v:
+            stats.error_404(package_name)
+            LOG.debug("Package " + package_name + " not available: %s" % v)
+            return None, None
+
+        # scans the package directory
+        mirror_package = blocking(self.package, package_name)
+
+        for (url, url_basename, md5_hash) in links:
+            #if url.find('prdownloads.sourceforge.net') > -1 and url.find('?download') > -1:
+            #   url = url.split('?')[0]
+            #   url_basename = url_basename.split('?')[0]
             try:
-                links = package.ls(filename_matches, external_links, 
-                                   follow_external_index_pages)
+               url, filename = self._extract_filename(url, stats)
             except PackageError, v:
-                stats.error_404(package_name)
-                LOG.debug("Package " + package_name + " not available: %s" % v)
-                continue
-
-            mirror_package = self.package(package_name)
-
-            for (url, url_basename, md5_hash) in links:
-                #if url.find('prdownloads.sourceforge.net') > -1 and url.find('?download') > -1:
-                #   url = url.split('?')[0]
-                #   url_basename = url_basename.split('?')[0]
-                try:
-                   url, filename = self._extract_filename(url)
-                except PackageError, v:
-                   stats.error_invalid_url((url, url_basename, md5_hash))
-                   LOG.info("Invalid URL: " + url + " %s" % v)
-                   continue                                
-                 
-
-                if url != None and filename != None:
-                  # LOG.debug ("--> " + url + " [" + filename + "]")
-                  # if we have a md5 check hash and continue if fine.
-                  
-                  if (md5_hash and mirror_package.md5_match(url_basename, md5_hash)) or \
-                     os.path.exists(os.path.join(local_pypi_path, package_name, filename)):
-                      stats.found(filename)
-                      full_list.append(mirror_package._html_link(base_url, 
-                                                                 url_basename, 
-                                                                 md5_hash))
+               stats.error_invalid_url((url, url_basename, md5_hash))
+               LOG.info("Invalid URL: " + url + " %s" % v)
+               continue                                
+             
+
+            if url != None and filename != None:
+              # LOG.debug ("--> " + url + " [" + filename + "]")
+              # if we have a md5 check hash and continue if fine.
+              
+              if (md5_hash and blocking(mirror_package.md5_match, url_basename, md5_hash)) or \
+                 blocking(mirror_package.exists, filename):
+                  stats.found(filename)
+                  full_list.append("%s\t%s" % (url_basename, package_name))
+                  if verbose: 
+                      LOG.debug("  Found: %s" % filename)
+                  continue
+
+              # the same bytes may be stored for another package already
+              if md5_hash and STORE and STORE.has(md5_hash) and \
+                 blocking(mirror_package.link, filename, md5_hash, url):
+                  stats.linked(filename)
+                  changed.add(package_name)
+                  full_list.append("%s\t%s" % (filename, package_name))
+                  if verbose:
+                      LOG.debug("  Linked from store: %s" % filename)
+                  continue
+              
+              # if we don't have a md5, check for the filesize, if available
+              # and continue if it's the same:
+              if not md5_hash:
+                  remote_size = package.content_length(url)
+                  if blocking(mirror_package.size_match, url_basename, remote_size):
                       if verbose: 
-                          LOG.debug("  Found: %s" % filename)
+                          LOG.debug("  Found: %s" % url_basename)
+                      full_list.append("%s\t%s" % (url_basename, package_name))
                       continue
-                  
-                  # if we don't have a md5, check for the filesize, if available
-                  # and continue if it's the same:
-                  if not md5_hash:
-                      remote_size = package.content_length(url)
-                      if mirror_package.size_match(url_basename, remote_size):
-                          if verbose: 
-                              LOG.debug("  Found: %s" % url_basename)
-                          full_list.append(mirror_package._html_link(base_url, url_basename, md5_hash))
-                          continue
-                
-                  # we need to download it
-                  #while True:
-                  try:
-                      LOG.debug("Attempting Download: %s" % url)
-                      data = package.get((url, filename, md5_hash))
-                  except PackageError, v:
-                      stats.error_invalid_url((url, url_basename, md5_hash))
-                      LOG.info("Invalid URL: " + url + " %s" % v)
-                      continue
-                                        
-                  mirror_package.write(filename, data, md5_hash)
-                  stats.stored(filename)
-                  # base_url
-                  # url_basename
-                  full_list.append(mirror_package._html_link(base_url, filename, md5_hash))
-                  if verbose:
-                      LOG.debug("  Stored File  : %s [%d kB]" % (filename, len(data)//1024))
-                  
-                  fullpath_filename = os.path.join(local_pypi_path, package_name, filename)
-                  LOG.debug ("  Touching archive: " + fullpath_filename)    
-                  touch_archives.process_file(fullpath_filename, False)
-            open(pkg_ctr_filename, "w").write(str(cur_pkg_counter-1))
-
-# Disabled cleanup for now since it does not deal with the changelog() implementation
-#            if cleanup:
-#                mirror_package.cleanup(links, verbose)
-            if create_indexes and filename != None:
-                mirror_package.index_html(base_url)
-#        if cleanup:
-#            self.cleanup(package_list, verbose)
-
-        # The pass has completed successfully so delete the temporary
-        # counter and the pickled package-list files 
-        if os.path.isfile(pkg_ctr_filename):
-           os.remove(pkg_ctr_filename)
-        if os.path.isfile("packages.p"):
-           os.remove("packages.p")
-        if os.path.isfile("incremental_packages.p"):
-           os.remove("incremental_packages.p")
-        
-        # Generate the local HTML pages
-        if create_indexes and filename != None:
-            self.index_html()
-            full_list.sort()
-            self.full_html(full_list)
-
-        for line in stats.getStats():
-            LOG.debug(line)
-
-    def _extract_filename(self, url):
+            
+              # we need to download it
+              #while True:
+              try:
+                  LOG.debug("Attempting Download: %s" % url)
+                  size = package.get((url, filename, md5_hash), mirror_package)
+              except PackageError, v:
+                  stats.error_invalid_url((url, url_basename, md5_hash))
+                  LOG.info("Invalid URL: " + url + " %s" % v)
+                  continue
+                                    
+              stats.stored(filename)
+              changed.add(package_name)
+              full_list.append("%s\t%s" % (filename, package_name))
+              if verbose:
+                  LOG.debug("  Stored File  : %s [%d kB]" % (filename, size//1024))
+        return filename, mirror_package
+
+    def _extract_filename(self, url, stats=None):
         """Get the real filename from an arbitary pypi download url.      
         We need to use heuristics here to avoid a many HEAD
         requests. Use them only if heuristics is not possible. 
+        What the HEAD requests found out is kept in the HEAD cache,
+        which is only asked about the urls the heuristics can't resolve.
+        """
+        cached = None
+        if HEADS and '?' in os.path.basename(url):
+            cached = HEADS.lookup(url)
+        if cached is not None and cached.final_url is not None:
+            if stats is not None:
+                stats.head_cache_hit(url)
+            return [cached.final_url or None, cached.filename or None]
+        (fetch_url, filename), heads, resp = self._resolve_filename(url, stats)
+        if HEADS and heads:
+            status = resp.status_code if resp is not None else None
+            HEADS.store_resolution(url, fetch_url, filename, 200 if filename else status)
+            if fetch_url and status == 200:
+                # spares content_length() another HEAD of the final url
+                HEADS.store_length(fetch_url, head_content_length(resp), status)
+        return [fetch_url, filename]
+
+    def _resolve_filename(self, url, stats=None):
+        """ does the work of _extract_filename. Returns the url and
+            filename, the number of HEAD requests sent and the last
+            response.
         """
         fetch_url = url
         #old_fetch_url = ""
         extract_counter = 0
+        resp = None
         do_again = True
         while do_again:
             # heuristics start
@@ -817,52 +1661,144 @@ class Mirror(object):
                LOG.debug("Fetch URL is " + fetch_url)
                
             if '?' not in url_basename:
-                return [fetch_url, os.path.basename(fetch_url)]
+                return [fetch_url, os.path.basename(fetch_url)], extract_counter, resp
 
             if extract_counter > 15:
-                return [None, None]
+                return [None, None], extract_counter, resp
             # now we have get parameters, we need to do a head 
             # request to get the filename
             extract_counter += 1
             try:
                 LOG.debug("Head-Request to get filename for %s" % fetch_url)
-                parsed_url = urlparse.urlparse(fetch_url)
-                if parsed_url.scheme == 'https':
-                    port = parsed_url.port or 443
-                    conn = httplib.HTTPSConnection(parsed_url.netloc, port)
-                else:
-                    port = parsed_url.port or 80
-                    conn = httplib.HTTPConnection(parsed_url.netloc, port)
-                conn.request('HEAD', fetch_url)
-                resp = conn.getresponse()
-                #print "Location " + resp.getheader("Location", None)
-                if resp.status in (301, 302):
-                    fetch_url = resp.getheader("Location", None)
+                start = time.time()
+                resp = HTTP.head(fetch_url)
+                if stats is not None:
+                    stats.record('head', time.time() - start)
+                #print "Location " + resp.headers.get("Location")
+                if resp.status_code in (301, 302):
+                    location = resp.headers.get("Location")
+                    fetch_url = location and urlparse.urljoin(fetch_url, location)
                     if fetch_url.find('sourceforge.net') > -1 and fetch_url.find('/OldFiles/') > -1:
                        LOG.debug("SourceForge 'Old File' (Invalid Redirect)")
-                       return [None, None]
+                       return [None, None], extract_counter, resp
                        
-                    #print "Location " + resp.getheader("Location", None)
+                    #print "Location " + resp.headers.get("Location")
                     if fetch_url is not None:
                         continue
                     raise PackageError, "Redirect (%s) from %s without location" % \
-                                        (resp.status, fetch_url)
-                elif resp.status != 200:                
+                                        (resp.status_code, fetch_url)
+                elif resp.status_code != 200:                
                     raise PackageError, "URL %s can't be fetched" % fetch_url
                 do_again = False
+            except HostThrottled:
+                raise
             except:
                 pass  
-        content_disposition = resp.getheader("Content-Disposition", None)
+        content_disposition = resp.headers.get("Content-Disposition")
         if content_disposition:
             content_disposition = [_.strip() for _ in \
                                    content_disposition.split(';') \
                                    if _.strip().startswith('filename')]
             if len(content_disposition) == 1 and '=' in content_disposition[0]:
-                return [fetch_url, content_disposition[0].split('=')[1].strip('"')]
+                return [fetch_url, content_disposition[0].split('=')[1].strip('"')], extract_counter, resp
         # so we followed redirects and no meaningful name came back, last 
         # fallback is to use the basename w/o request parameters.
         # if this is wrong, it has to fail later. 
-        return [fetch_url, os.path.basename(fetch_url[:fetch_url.find('?')])]
+        return [fetch_url, os.path.basename(fetch_url[:fetch_url.find('?')])], extract_counter, resp
+
+class _ListedFile(object):
+    """ stands in for a scandir entry when scandir isn't installed """
+    def __init__(self, path):
+        self.path = path
+
+    def stat(self):
+        return os.stat(self.path)
+
+
+class PackageManifest(object):
+    """ The files of a package directory as found by a single scan of
+        it, so that presence, size and md5 checks don't cost a filesystem
+        call each, which on NFS means a round trip each. A file is
+        stat-ed and its .md5 sidecar read when first asked about;
+        MirrorPackage updates the manifest for every file it writes or
+        removes. Without scandir the scan is a plain listdir, which can't
+        tell files from directories; package directories hold no
+        subdirectories, and one is dropped once it is stat-ed.
+    """
+    def __init__(self, path):
+        self.path = path
+        # filename -> os.stat result, or a scandir entry not stat-ed yet
+        self._files = {}
+        # filename -> md5 from its ".<filename>.md5" sidecar, None until read
+        self._sidecars = {}
+        self._scan()
+
+    def _scan(self):
+        try:
+            if scandir is not None:
+                entries = [(entry.name, entry) for entry in scandir(self.path)
+                           if entry.is_file()]
+            else:
+                entries = [(name, _ListedFile(os.path.join(self.path, name)))
+                           for name in os.listdir(self.path)]
+        except OSError:
+            entries = []
+        for name, entry in entries:
+            if name.startswith(".") and name.endswith(".md5"):
+                self._sidecars[name[1:-4]] = None
+            else:
+                self._files[name] = entry
+
+    def has(self, filename):
+        return filename in self._files
+
+    def stat(self, filename):
+        """ returns the os.stat result of filename or None """
+        entry = self._files.get(filename)
+        if entry is not None and not isinstance(entry, os.stat_result):
+            try:
+                entry = entry.stat()
+            except OSError:
+                entry = None
+            if entry is None or S_ISDIR(entry.st_mode):
+                del self._files[filename]
+                return None
+            self._files[filename] = entry
+        return entry
+
+    def size(self, filename):
+        stat = self.stat(filename)
+        return stat.st_size if stat is not None else 0
+
+    def sidecar_md5(self, filename):
+        """ returns the md5 kept in the sidecar of filename or None """
+        if filename not in self._sidecars:
+            return None
+        if self._sidecars[filename] is None:
+            sidecar = os.path.join(self.path, ".%s.md5" % filename)
+            try:
+                self._sidecars[filename] = open(sidecar, "r").read()
+            except IOError:
+                del self._sidecars[filename]
+                return None
+        return self._sidecars[filename]
+
+    def names(self):
+        """ the sorted names of the files, without hidden ones """
+        return sorted(name for name in self._files if not name.startswith("."))
+
+    def written(self, filename, md5=None):
+        """ records that filename (and its sidecar, if md5 is given) was
+            written
+        """
+        self._files[filename] = os.stat(os.path.join(self.path, filename))
+        if md5:
+            self._sidecars[filename] = md5
+
+    def removed(self, filename):
+        self._files.pop(filename, None)
+        self._sidecars.pop(filename, None)
+
 
 class MirrorPackage(object):
     """ This checks for already existing files and creates the index
@@ -871,26 +1807,50 @@ class MirrorPackage(object):
         self.package_name = package_name
         self.mirror = mirror
         self.mkdir()
+        self.manifest = PackageManifest(self.path())
 
     def mkdir(self):
-        try:
-            os.mkdir(self.path())
-        except OSError:
-            # like "File exists"
-            pass
+        make_package_dir(self.path())
 
     def path(self, filename=None):
         if not filename:
-            return os.path.join(self.mirror.base_path, self.package_name)
-        return os.path.join(self.mirror.base_path, self.package_name, filename)
+            return package_dir(self.mirror.base_path, self.package_name)
+        return os.path.join(package_dir(self.mirror.base_path, self.package_name), filename)
 
     def md5_match(self, filename, md5):
-        file = MirrorFile(self, filename)
-        return file.md5 == md5
+        if FILE_INDEX:
+            record = FILE_INDEX.lookup(self.package_name, filename)
+            if record and record.md5:
+                return record.md5 == md5
+        file_md5 = self.manifest.sidecar_md5(filename)
+        if file_md5 is None and self.manifest.has(filename):
+            file_md5 = MirrorFile(self, filename).md5
+        if FILE_INDEX and file_md5 and self.manifest.has(filename):
+            self._index_file(filename, file_md5)
+        return file_md5 == md5
 
     def size_match(self, filename, size):
-        file = MirrorFile(self, filename)
-        return file.size == size
+        if FILE_INDEX:
+            record = FILE_INDEX.lookup(self.package_name, filename)
+            if record:
+                return record.size == size
+        return self.manifest.size(filename) == size
+
+    def exists(self, filename):
+        if FILE_INDEX and FILE_INDEX.lookup(self.package_name, filename):
+            return True
+        if not self.manifest.has(filename):
+            return False
+        if FILE_INDEX:
+            self._index_file(filename)
+        return True
+
+    def _index_file(self, filename, md5=None, url=None):
+        """ adds a file found on disk to the FILE_INDEX """
+        if md5 is None:
+            md5 = self.manifest.sidecar_md5(filename)
+        stat = self.manifest.stat(filename)
+        FILE_INDEX.record(self.package_name, filename, stat.st_size, md5, stat.st_mtime, url)
 
     def write(self, filename, data, hash=""):
         self.mkdir()
@@ -898,39 +1858,133 @@ class MirrorPackage(object):
         file.write(data)
         if hash:
             file.write_md5(hash)
+        self.manifest.written(filename, hash)
+
+    def partial(self, filename):
+        self.mkdir()
+        return PartialDownload(MirrorFile(self, filename))
+
+    def commit(self, filename, partial, hash="", url=None, digest=None, mtime=None, stats=None):
+        """ moves a completed download into place, timestamps it and
+            records it in the FILE_INDEX. mtime is the newest archive
+            member time if it was worked out during the download,
+            otherwise the archive is read once more to find it.
+        """
+        partial.commit()
+        if hash:
+            MirrorFile(self, filename).write_md5(hash)
+        LOG.debug("  Touching archive: " + self.path(filename))
+        start = time.time()
+        if mtime is not None:
+            touch_archives.touch_file(self.path(filename), mtime)
+        else:
+            touch_archives.process_file(self.path(filename), False)
+        if stats is not None:
+            stats.record('touch', time.time() - start)
+        if STORE and (hash or digest):
+            try:
+                STORE.adopt(self.path(filename), hash or digest)
+            except (OSError, ValueError), e:
+                LOG.warn("Keeping a separate copy of %s: %s" % (self.path(filename), e))
+        self.manifest.written(filename, hash)
+        if FILE_INDEX:
+            self._index_file(filename, hash or digest, url)
+
+    def link(self, filename, digest, url=None):
+        """ puts the content store entry of digest in place as filename.
+            Returns False if the link can't be made (store on another
+            filesystem, too many links, no hardlinks), the file has to be
+            downloaded then.
+        """
+        try:
+            STORE.link(digest, self.path(filename))
+        except OSError, e:
+            LOG.warn("Couldn't link %s from the content store: %s" % (self.path(filename), e))
+            return False
+        MirrorFile(self, filename).write_md5(digest)
+        self.manifest.written(filename, digest)
+        if FILE_INDEX:
+            self._index_file(filename, digest, url)
+        return True
 
     def rm(self, filename):
         MirrorFile(self, filename).rm()
+        self.manifest.removed(filename)
+        if FILE_INDEX:
+            FILE_INDEX.remove(self.package_name, filename)
 
     def ls(self):
-        filenames = []
-        for filename in os.listdir(self.path()):
-            if os.path.isfile(self.path(filename)) and filename != "index.html"\
-               and not filename.endswith(".md5"):
-                filenames.append(filename)
-        filenames.sort()
-        return filenames
+        return [filename for filename in self.manifest.names()
+                if not filename.startswith(("index.html", JSON_INDEX_FILENAME))
+                and not filename.endswith(".md5")]
+
+    def archives(self):
+        """ ls() without the info pages and DOAP records _save_info()
+            writes, i.e. the files mirrored from the package links
+        """
+        return [filename for filename in self.ls() if not filename.endswith(INFO_SUFFIXES)]
+
+    def files(self):
+        """ returns (filename, md5, size) of every file of ls(). The md5
+            comes from the FILE_INDEX or the .md5 sidecar and is None if
+            neither knows it.
+        """
+        known = FILE_INDEX.package_files(self.package_name) if FILE_INDEX else {}
+        files = []
+        for filename in self.ls():
+            record = known.get(filename)
+            if record is not None:
+                files.append((filename, record.md5 or self.manifest.sidecar_md5(filename), record.size))
+            else:
+                files.append((filename, self.manifest.sidecar_md5(filename), self.manifest.size(filename)))
+        return files
 
     def _html_link(self, base_url, filename, md5_hash):
         base_url = ''
+        if md5_hash:
+            return '<a href="%s#md5=%s">%s</a>' % (filename, md5_hash, filename)
         return '<a href="%s">%s</a>' % (filename, filename)
 
-    def _index_html(self, base_url):
+    def _write_index_html(self, fp, base_url, files):
         header = "<html><head><title>%s &ndash; PyPI Mirror</title></head><body>" % self.package_name
         footer = "</body></html>"
-
-        link_list = []
-        for link in self.ls():
-            file = MirrorFile(self, link)
-            md5_hash = file.md5
-            link_list.append(self._html_link(base_url, link, md5_hash))
-        links = "<br />\n".join(link_list)
         divr = "<hr><center><a href=info.html>Info<hr></a></center>"
-        return "%s%s%s%s" % (header, divr, links, footer)
+        fp.write(header + divr)
+        separator = ""
+        for filename, md5_hash, size in files:
+            fp.write(separator + self._html_link(base_url, filename, md5_hash))
+            separator = "<br />\n"
+        fp.write(footer)
+
+    def _write_index_json(self, fp, files):
+        """ the PEP 691 project page. Only distributions are listed, not
+            the info pages and DOAP records; "size" is added as PEP 700
+            has it, clients of api-version 1.0 ignore it.
+        """
+        fp.write('{"meta": {"api-version": "1.0"}, "name": %s, "files": ['
+                 % json.dumps(normalize_name(self.package_name)))
+        separator = "\n"
+        for filename, md5_hash, size in files:
+            if filename.endswith(INFO_SUFFIXES):
+                continue
+            entry = collections.OrderedDict((("filename", filename), ("url", filename),
+                                             ("hashes", {"md5": md5_hash} if md5_hash else {}),
+                                             ("size", size)))
+            fp.write(separator + json.dumps(entry))
+            separator = ",\n"
+        fp.write("\n]}\n")
 
     def index_html(self, base_url):
-        content = self._index_html(base_url)
-        self.write("index.html", content)
+        """ writes index.html and with JSON_INDEX its PEP 691 variant """
+        self.mkdir()
+        files = self.files()
+        with page(self.path("index.html")) as fp:
+            self._write_index_html(fp, base_url, files)
+        self.manifest.written("index.html")
+        if JSON_INDEX:
+            with page(self.path(JSON_INDEX_FILENAME)) as fp:
+                self._write_index_json(fp, files)
+            self.manifest.written(JSON_INDEX_FILENAME)
 
     def cleanup(self, original_file_list, verbose=False):
         return
@@ -959,7 +2013,14 @@ class MirrorFile(object):
             return open(self.md5_filename,"r").read()
 
         if os.path.exists(self.path):
-            return md5(open(self.path, "rb").read()).hexdigest()
+            checksum = md5()
+            with open(self.path, "rb") as fp:
+                while True:
+                    chunk = fp.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    checksum.update(chunk)
+            return checksum.hexdigest()
         return None
 
     @property
@@ -970,6 +2031,7 @@ class MirrorFile(object):
 
     def write(self, data):
         open(self.path, "wb").write(data)
+
         
 
     def rm(self):
@@ -991,12 +2053,99 @@ class MirrorFile(object):
         md5_path = os.path.dirname(self.path)
         return os.path.join(md5_path, md5_filename)
 
+class PartialDownload(object):
+    """ A download in progress. The bytes received so far are kept in a
+        hidden ".<filename>.part" file next to the target, together with
+        a ".<filename>.part.json" state file holding the url, md5 and
+        the validators needed to continue with a Range request.
+    """
+    def __init__(self, mirror_file):
+        path, filename = os.path.split(mirror_file.path)
+        self.mirror_file = mirror_file
+        self.path = os.path.join(path, ".%s.part" % filename)
+        self.state_filename = self.path + ".json"
+
+    @property
+    def size(self):
+        if os.path.exists(self.path):
+            return os.path.getsize(self.path)
+        return 0
+
+    def state(self):
+        try:
+            return json.load(open(self.state_filename, "r"))
+        except (IOError, ValueError):
+            return None
+
+    def resume_headers(self, url, md5_hex):
+        """ returns the request headers to continue this download or an
+            empty dict if it has to start from the beginning
+        """
+        state = self.state()
+        size = self.size
+        if not state or not size or state.get("url") != url or state.get("md5") != md5_hex:
+            return {}
+        headers = {"Range": "bytes=%d-" % size}
+        validator = state.get("etag") or state.get("last_modified")
+        if validator:
+            headers["If-Range"] = validator
+        elif not md5_hex:
+            # without a validator or a md5 to check the result against
+            # we can't tell whether the remote file changed meanwhile
+            return {}
+        return headers
+
+    def continued_by(self, response):
+        """ True if response holds the missing tail of the .part file """
+        if response.status_code != 206:
+            return False
+        content_range = response.headers.get("content-range", "")
+        return content_range.startswith("bytes %d-" % self.size)
+
+    def start(self, url, md5_hex, response):
+        """ starts the .part file over; returns it opened for writing """
+        etag = response.headers.get("etag")
+        if etag and etag.startswith("W/"):
+            # weak validators can't be used with If-Range
+            etag = None
+        state = {"url": url,
+                 "md5": md5_hex,
+                 "etag": etag,
+                 "last_modified": response.headers.get("last-modified")}
+        json.dump(state, open(self.state_filename, "w"))
+        return open(self.path, "wb")
+
+    def resume(self, *consumers):
+        """ feeds the bytes already on disk to the consumers (a checksum
+            or an ArchiveTimer) and returns the .part file opened for
+            appending
+        """
+        with open(self.path, "rb") as fp:
+            while True:
+                chunk = fp.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                for consumer in consumers:
+                    consumer.update(chunk)
+        return open(self.path, "ab")
+
+    def commit(self):
+        os.rename(self.path, self.mirror_file.path)
+        if os.path.exists(self.state_filename):
+            os.unlink(self.state_filename)
+
+    def discard(self):
+        for filename in (self.path, self.state_filename):
+            if os.path.exists(filename):
+                os.unlink(filename)
+
 ################# Config file parser
 
 default_logfile = os.path.join(tempfile.tempdir or '/tmp', 'pypimirror.log')
 
 config_defaults = {
     'base_url': 'http://your-host.com/index/',
+    'pypi_url': 'https://pypi.python.org', # index to mirror (simple pages, info pages and XML-RPC)
     'mirror_file_path': '/tmp/mirror',
     'lock_file_name': 'pypi-poll-access.lock',
     'filename_matches': '*.zip *.tgz *.egg *.tar.gz *.tar.bz2 *.whl *.py *.md *.md5 *.xml *.sha1', # may be "" for *
@@ -1007,6 +2156,40 @@ config_defaults = {
     'log_filename': default_logfile,
     'external_links': True, # experimental external link resolve and download
     'follow_external_index_pages' : True, # experimental, scan index pages for links
+    'workers': 1, # number of packages processed concurrently
+    'engine': 'threads', # "threads" or "async" (event loop, needs gevent)
+    'async_concurrency': 1000, # packages in flight with the async engine
+    'async_writer_threads': 4, # threads writing files for the async engine
+    'http_pool_connections': 10, # number of hosts to keep connection pools for
+    'http_pool_maxsize': 10, # open connections kept per host (raised to workers; with the async engine the limit of requests in flight per host)
+    'http_keep_alive': True, # reuse connections between requests
+    'http_connect_timeout': 30, # seconds
+    'http_read_timeout': 60, # seconds
+    'http_retries': 3, # retries of a request answered with 429/503
+    'host_max_concurrency': 10, # upper bound of the adaptive number of requests in flight per host
+    'host_rate_limit': 0, # requests per second per host, 0 for no cap
+    'host_rate_limits': '', # caps for single hosts, e.g. "downloads.sourceforge.net=1 github.com=5"
+    'host_slow_latency': 10, # seconds to the response headers; slower responses shrink the host's concurrency
+    'host_park_after': 5, # seconds; packages waiting longer for a throttled host are parked
+    'state_db_filename': '.pypimirror.db', # state kept between runs, relative to mirror_file_path
+    'http_cache': True, # send conditional requests for index and info pages
+    'head_cache': True, # remember redirect resolutions and content-length probes between runs
+    'head_cache_ttl': 168, # hours a HEAD cache entry is used
+    'head_cache_negative_ttl': 6, # hours a failed HEAD request is remembered
+    'serial_filename': '.last_serial', # last synced changelog serial, relative to mirror_file_path
+    'file_index': True, # answer "already mirrored?" from the state db instead of the filesystem
+    'layout': 'flat', # "flat" or "sharded" (package directories in <2 hex digits of the md5 of the name>/), for a new mirror
+    'json_index': True, # also write PEP 691 JSON index pages (index.v1_json) with md5 hashes and sizes
+    'index_encodings': 'gz', # precompressed variants written next to the index pages: gz, br (needs brotli); "" for none
+    'rewrite_map_filename': '', # map of PEP 503 names to package directories for the web server, relative to mirror_file_path; "" to disable
+    'rewrite_map_format': 'apache', # "apache" (RewriteMap txt:) or "nginx" (map include)
+    'content_store': False, # keep archives once, by md5, and hardlink them into the package directories
+    'content_store_path': '.store', # relative to mirror_file_path, has to be on the same filesystem
+    'journal_filename': '.pypimirror.journal', # completed packages of the current run, relative to mirror_file_path
+    'stats_json_filename': '.last_run_stats.json', # JSON summary of the last run, relative to mirror_file_path; "" to disable
+    'metrics_textfile': '', # Prometheus textfile updated during the run, e.g. for the node exporter; "" to disable
+    'metrics_interval': 60, # seconds between updates of the metrics_textfile
+    'error_log_filename': '.last_run_errors.txt', # every error of the last run, relative to mirror_file_path; "" to disable
 }
 
 
@@ -1039,6 +2222,18 @@ def get_config_options(config_filename):
 def run(args=None):
    
     global LOG
+    global PYPI_URL
+    global HTTP
+    global STATE
+    global VALIDATORS
+    global HEADS
+    global STORE
+    global LAYOUT
+    global PAGE_ENCODINGS
+    global JSON_INDEX
+    global FILE_INDEX
+    global DESCRIPTIONS
+    global ENGINE
     global local_pypi_path
     
     usage = "usage: pypimirror [options] <config-file>"
@@ -1054,7 +2249,7 @@ def run(args=None):
     parser.add_option('-c', '--log-console', dest='log_console', action='store_true',
                       default=True, help='Also log to console')
     parser.add_option('-i', '--indexes-only', dest='indexes_only', action='store_true',
-                      default=False, help='create indexes only (no mirroring)')
+                      default=False, help='create indexes only (no mirroring), for every package and the mirror root')
     parser.add_option('-e', '--follow-external-links', dest='external_links', action='store_true',
                       default=True, help='Follow and download external links)')
     parser.add_option('-x', '--follow-external-index-pages', dest='follow_external_index_pages', action='store_true',
@@ -1068,10 +2263,23 @@ def run(args=None):
     parser.add_option('-n', '--nonstop', dest='nonstop', action='store_true',
                       default=False, help='nonstop loop')
     parser.add_option('-r', '--restart', dest='restart', action='store_true',
-                      default=False, help='restart with clean indexes')
+                      default=False, help='restart with a new package list instead of continuing an interrupted run')
     parser.add_option('-w', '--write-expanded-index', dest='write_expanded_index', action='store_true',
                       default=False, help='Write index with project descriptions')
-    options, args = parser.parse_args()
+    parser.add_option('-S', '--serial-sync', dest='serial_sync', action='store_true',
+                      default=False, help='Perform incremental update from the changelog serial of the last run')
+    parser.add_option('--rebuild-file-index', dest='rebuild_file_index', action='store_true',
+                      default=False, help='Rebuild the file index from the mirror directory and exit')
+    parser.add_option('--rebuild-registry', dest='rebuild_registry', action='store_true',
+                      default=False, help='Rebuild the package registry (and rewrite map) from the mirror directory and exit')
+    parser.add_option('--dedupe', dest='dedupe', action='store_true',
+                      default=False, help='Move the mirrored files into the content store, link duplicates and exit')
+    parser.add_option('--workers', dest='workers', action='store', type='int',
+                      default=None, help='Number of packages to process concurrently')
+    parser.add_option('--engine', dest='engine', action='store', type='choice',
+                      choices=['threads', 'async'], default=None,
+                      help='Fetch with worker threads (default) or an event loop (async, needs gevent)')
+    options, args = parser.parse_args(args)
     if len(args) != 1:
         parser.error("No configuration file specified")
         sys.exit(1)
@@ -1083,14 +2291,43 @@ def run(args=None):
     
     # correct things from config
     nonstop = options.nonstop
-    filename_matches = config["filename_matches"].split()
-    package_matches = config["package_matches"].split()
+    filename_matches = util.PatternMatcher(config["filename_matches"].split())
+    package_matches = util.PatternMatcher(config["package_matches"].split())
     cleanup = config["cleanup"] in ("True", "1")
     create_indexes = config["create_indexes"] in ("True", "1")
     verbose = config["verbose"] in ("True", "1") or options.verbose
     external_links = config["external_links"] in ("True", "1") or options.external_links
     follow_external_index_pages = config["follow_external_index_pages"] in ("True", "1") or options.follow_external_index_pages
     log_filename = config['log_filename']
+    workers = max(1, int(options.workers or config["workers"]))
+    LAYOUT = config["layout"]
+    if LAYOUT not in ('flat', 'sharded'):
+        parser.error("Unknown layout: %s" % LAYOUT)
+    PAGE_ENCODINGS = tuple(config["index_encodings"].split())
+    JSON_INDEX = str(config["json_index"]) in ("True", "1")
+    for encoding in PAGE_ENCODINGS:
+        if encoding not in page_writer.ENCODINGS:
+            parser.error("Unknown index encoding: %s" % encoding)
+        if not page_writer.available(encoding):
+            parser.error("The %s index encoding needs the brotli module" % encoding)
+    rewrite_map = None
+    if config["rewrite_map_filename"]:
+        rewrite_map = os.path.join(config["mirror_file_path"], config["rewrite_map_filename"])
+    engine = options.engine or config["engine"]
+    if engine not in ('threads', 'async'):
+        parser.error("Unknown engine: %s" % engine)
+    if engine == 'async':
+        if not async_engine.available():
+            parser.error("The async engine needs gevent")
+        if not async_engine.patched():
+            # patching socket and ssl now that requests holds on to them
+            # isn't reliable
+            parser.error("The async engine has to be chosen before the network modules are "
+                         "imported: start mirror.py as a script or call async_engine.patch() first")
+        ENGINE = async_engine.Engine(concurrency=int(config["async_concurrency"]),
+                                     writer_threads=int(config["async_writer_threads"]))
+    else:
+        ENGINE = None
     
     if options.autocalc:
        seconds_past = time.time() - os.path.getmtime(log_filename)
@@ -1109,46 +2346,128 @@ def run(args=None):
         log_filename = options.log_filename
 
     LOG = getLogger(filename=log_filename, log_console=options.log_console)
+    PYPI_URL = config["pypi_url"].rstrip('/')
+    pool_maxsize = int(config["http_pool_maxsize"])
+    if ENGINE is None:
+        # every worker thread may need a connection to the same host
+        pool_maxsize = max(workers, pool_maxsize)
+    scheduler = HostScheduler(max_concurrency=int(config["host_max_concurrency"]),
+                              rate=float(config["host_rate_limit"]),
+                              rates=dict((host.lower(), float(rate)) for host, rate in
+                                         (cap.split('=', 1) for cap in config["host_rate_limits"].split())),
+                              slow_latency=float(config["host_slow_latency"]),
+                              park_after=float(config["host_park_after"]))
+    HTTP = HttpPool(pool_connections=int(config["http_pool_connections"]),
+                    pool_maxsize=pool_maxsize,
+                    scheduler=scheduler,
+                    retries=int(config["http_retries"]),
+                    keep_alive=str(config["http_keep_alive"]) in ("True", "1"),
+                    connect_timeout=float(config["http_connect_timeout"]),
+                    read_timeout=float(config["http_read_timeout"]))
+
+
+    if options.rebuild_file_index:
+        mirror = Mirror(config["mirror_file_path"])
+        lock = zc.lockfile.LockFile(os.path.join(config["mirror_file_path"], config["lock_file_name"]))
+        STATE = StateDB(os.path.join(config["mirror_file_path"], config["state_db_filename"]), blocking=blocking)
+        try:
+            count = mirror.rebuild_file_index(FileIndex(STATE))
+            LOG.debug("File index rebuilt: %d files" % count)
+        finally:
+            STATE.close()
+        return
 
+    store = ContentStore(os.path.join(config["mirror_file_path"], config["content_store_path"]))
+    if options.dedupe:
+        mirror = Mirror(config["mirror_file_path"])
+        lock = zc.lockfile.LockFile(os.path.join(config["mirror_file_path"], config["lock_file_name"]))
+        STATE = StateDB(os.path.join(config["mirror_file_path"], config["state_db_filename"]), blocking=blocking)
+        if str(config["file_index"]) in ("True", "1"):
+            FILE_INDEX = FileIndex(STATE)
+        try:
+            report = mirror.dedupe(store)
+        finally:
+            STATE.close()
+        for line in report.lines():
+            LOG.debug(line)
+            print line
+        return
+    if str(config["content_store"]) in ("True", "1"):
+        STORE = store
+
+    mirror = Mirror(config["mirror_file_path"], rewrite_map, config["rewrite_map_format"])
+    
+ 
+    lock = zc.lockfile.LockFile(os.path.join(config["mirror_file_path"], config["lock_file_name"]))
+
+    if options.rebuild_registry:
+        count = mirror.rebuild_registry()
+        LOG.debug("Package registry rebuilt: %d packages" % count)
+        return
 
+    journal = CompletionJournal(os.path.join(config["mirror_file_path"], config["journal_filename"]))
     if options.restart:
         print time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()) + (" " * 12) + "Erasing old package data and restarting"
-        if os.path.isfile("pkg_ctr.txt"):
-           os.remove("pkg_ctr.txt")
-        if os.path.isfile("packages.p"):
-           os.remove("packages.p")
-        if os.path.isfile("incremental_packages.p"):
-           os.remove("incremental_packages.p")
-      
+        journal.finish()
+
+    serial_filename = None
+    if options.serial_sync:
+        serial_filename = os.path.join(config["mirror_file_path"], config["serial_filename"])
+    package_source = PypiPackageList()
 
     if options.initial_fetch:
-        package_list = PypiPackageList().list(package_matches, incremental=False)
-    elif options.update_fetch:
+        package_list = package_source.list(package_matches, incremental=False, serial_filename=serial_filename, journal=journal)
+    elif options.update_fetch or options.serial_sync:
         if fetch_since_hours > 0:
-           package_list = PypiPackageList().list(package_matches, incremental=True, fetch_since_days=0, fetch_since_hours=fetch_since_hours)
+           package_list = package_source.list(package_matches, incremental=True, fetch_since_days=0, fetch_since_hours=fetch_since_hours, serial_filename=serial_filename, journal=journal)
         else: 
-           package_list = PypiPackageList().list(package_matches, incremental=True, fetch_since_days=fetch_since_days)
+           package_list = package_source.list(package_matches, incremental=True, fetch_since_days=fetch_since_days, serial_filename=serial_filename, journal=journal)
         
     else: 
-        raise ValueError('You must either specify the --initial-fetch or --update-fetch option ')
-
-    mirror = Mirror(config["mirror_file_path"])
-    
- 
-    lock = zc.lockfile.LockFile(os.path.join(config["mirror_file_path"], config["lock_file_name"]))
-    
+        raise ValueError('You must either specify the --initial-fetch, --update-fetch or --serial-sync option ')
+
+    STATE = StateDB(os.path.join(config["mirror_file_path"], config["state_db_filename"]), blocking=blocking)
+    if str(config["http_cache"]) in ("True", "1"):
+        VALIDATORS = ValidatorCache(STATE)
+    if str(config["head_cache"]) in ("True", "1"):
+        HEADS = HeadCache(STATE, ttl=float(config["head_cache_ttl"]) * 3600,
+                          negative_ttl=float(config["head_cache_negative_ttl"]) * 3600)
+        HEADS.purge()
+    if str(config["file_index"]) in ("True", "1"):
+        FILE_INDEX = FileIndex(STATE)
+    DESCRIPTIONS = DescriptionIndex(STATE)
+
+    stats_json = None
+    if config["stats_json_filename"]:
+        stats_json = os.path.join(config["mirror_file_path"], config["stats_json_filename"])
+    error_filename = None
+    if config["error_log_filename"]:
+        error_filename = os.path.join(config["mirror_file_path"], config["error_log_filename"])
 
     expanded_index_written = False
 
     try:
         if options.indexes_only:
+            count = mirror.package_indexes(config["base_url"])
+            LOG.debug("Index pages of %d packages written" % count)
             mirror.index_html()
         else:
             while True:
                 try:
-                    mirror.mirror(package_list, filename_matches, verbose, 
+                    dropped = mirror.mirror(package_list, filename_matches, verbose, 
                                   cleanup, create_indexes, external_links, 
-                                  follow_external_index_pages, config["base_url"])
+                                  follow_external_index_pages, config["base_url"],
+                                  workers, journal,
+                                  stats_json=stats_json,
+                                  metrics_textfile=config["metrics_textfile"] or None,
+                                  metrics_interval=float(config["metrics_interval"]),
+                                  error_filename=error_filename)
+                    if dropped:
+                        # the packages left to the next run aren't covered yet
+                        LOG.debug('%d packages left to the next run, the changelog serial is kept' % len(dropped))
+                    elif package_source.serial is not None:
+                        write_last_serial(serial_filename, package_source.serial)
+                        LOG.debug('Mirror is up to date with changelog serial %d' % package_source.serial)
                     if not expanded_index_written and options.write_expanded_index:
                         expanded_index_written = True
                         mirror.expanded_index_html()
@@ -1161,12 +2480,17 @@ def run(args=None):
                    LOG.debug('Pausing ' + (str(fetch_since_hours) + ' hours ' if fetch_since_hours > 0 else '23 hours ') + 'for repeat... ')
                    if fetch_since_hours > 0:
                        time.sleep(3600 * fetch_since_hours) # 60 secs * 60 minutes = 1 Hour * Number of Hours to Pause
-                       package_list = PypiPackageList().list(package_matches, incremental=True, fetch_since_hours=fetch_since_hours)
+                       package_list = package_source.list(package_matches, incremental=True, fetch_since_hours=fetch_since_hours, serial_filename=serial_filename, journal=journal)
                    else:
                        time.sleep(3600 * 23)
-                       package_list = PypiPackageList().list(package_matches, incremental=True, fetch_since_days=1)
+                       package_list = package_source.list(package_matches, incremental=True, fetch_since_days=1, serial_filename=serial_filename, journal=journal)
     except:
        LOG.debug(GetExceptionInfo())
+    finally:
+       journal.close()
+       STATE.close()
+       if ENGINE is not None:
+           ENGINE.close()
 
 if __name__ == '__main__':
     sys.exit(run())
@@ -0,0 +1,115 @@
+################################################################
+# z3c.pypimirror - A PyPI mirroring solution
+# Written by Daniel Kraft, Josip Delic, Gottfried Ganssauge and
+# Andreas Jung
+#
+# Published under the Zope Public License 2.1
+################################################################
+
+"""
+Atomically replaced, precompressed index pages
+"""
+
+import gzip
+import os
+
+try:
+    import brotli # https://pypi.python.org/pypi/Brotli, optional
+except ImportError:
+    brotli = None
+
+# the encodings a PageWriter can add next to a page, by file suffix
+ENCODINGS = ('gz', 'br')
+
+
+def available(encoding):
+    return encoding == 'gz' or (encoding == 'br' and brotli is not None)
+
+
+class _Gzip(object):
+    def __init__(self, fp, filename):
+        # mtime 0 and the final name (GzipFile would take the name of
+        # the temporary file) keep the output the same for the same page
+        self.gzip = gzip.GzipFile(filename=os.path.basename(filename), fileobj=fp,
+                                  mode='wb', compresslevel=9, mtime=0)
+
+    def write(self, data):
+        self.gzip.write(data)
+
+    def finish(self):
+        self.gzip.close()
+
+
+class _Brotli(object):
+    def __init__(self, fp):
+        self.fp = fp
+        self.compressor = brotli.Compressor(mode=brotli.MODE_TEXT)
+
+    def write(self, data):
+        self.fp.write(self.compressor.process(data))
+
+    def finish(self):
+        self.fp.write(self.compressor.finish())
+
+
+class PageWriter(object):
+    """ A file-like object for writing a page. The page and its
+        compressed variants (filename.gz, filename.br for the encodings
+        asked for) are streamed to hidden temporary files and renamed
+        into place on close(), so a web server never serves a partial
+        page and can send the precompressed bytes as they are (nginx
+        gzip_static/brotli_static, Apache MultiViews). Leaving a with
+        block by an exception discards the temporary files and keeps the
+        old page.
+    """
+    def __init__(self, filename, encodings=()):
+        self.filename = filename
+        self._files = []
+        self._encoders = []
+        self._fp = self._open(filename)
+        for encoding in encodings:
+            fp = self._open("%s.%s" % (filename, encoding))
+            if encoding == 'gz':
+                self._encoders.append(_Gzip(fp, filename))
+            elif encoding == 'br':
+                self._encoders.append(_Brotli(fp))
+            else:
+                raise ValueError("Unknown encoding: %s" % encoding)
+
+    def _open(self, filename):
+        directory, name = os.path.split(filename)
+        temp_filename = os.path.join(directory, ".%s.tmp" % name)
+        fp = open(temp_filename, "wb")
+        self._files.append((fp, temp_filename, filename))
+        return fp
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self._fp.write(data)
+        for encoder in self._encoders:
+            encoder.write(data)
+
+    def close(self):
+        for encoder in self._encoders:
+            encoder.finish()
+        for fp, temp_filename, filename in self._files:
+            fp.close()
+        # the page itself last, its variants are never older than it
+        for fp, temp_filename, filename in reversed(self._files):
+            os.rename(temp_filename, filename)
+
+    def abort(self):
+        for fp, temp_filename, filename in self._files:
+            fp.close()
+            if os.path.exists(temp_filename):
+                os.unlink(temp_filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
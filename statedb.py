@@ -0,0 +1,258 @@
+################################################################
+# z3c.pypimirror - A PyPI mirroring solution
+# Written by Daniel Kraft, Josip Delic, Gottfried Ganssauge and
+# Andreas Jung
+#
+# Published under the Zope Public License 2.1
+################################################################
+
+"""
+Persistent state kept between runs of z3c.pypimirror
+"""
+
+import collections
+import json
+import sqlite3
+import threading
+import time
+
+
+class StateDB(object):
+    """ A small SQLite database holding state that has to survive between
+        runs. One connection is shared by all worker threads; writes are
+        committed in batches since losing the last few entries of a cache
+        after a crash does no harm.
+
+        blocking(function, *args) is called to run the queries, writes
+        and commits, e.g. on the writer threads of the async engine.
+    """
+    def __init__(self, filename, commit_every=100, blocking=None):
+        self.filename = filename
+        self._commit_every = commit_every
+        self._blocking = blocking
+        self._pending = 0
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        self._conn.text_factory = str
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+
+    def create(self, sql):
+        with self._lock:
+            self._conn.execute(sql)
+            self._conn.commit()
+
+    def _call(self, function, *args):
+        if self._blocking is None:
+            return function(*args)
+        return self._blocking(function, *args)
+
+    def query(self, sql, params=()):
+        return self._call(self._query, sql, params)
+
+    def _query(self, sql, params):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def write(self, sql, params=()):
+        self._call(self._write, sql, params)
+
+    def _write(self, sql, params):
+        with self._lock:
+            self._conn.execute(sql, params)
+            self._pending += 1
+            if self._pending >= self._commit_every:
+                self._commit()
+
+    def commit(self):
+        self._call(self._commit)
+
+    def _commit(self):
+        with self._lock:
+            self._conn.commit()
+            self._pending = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+
+class CachedPage(object):
+    """ Validators and parsed data of a page from the ValidatorCache """
+    def __init__(self, etag, last_modified, data):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.data = data
+
+    def request_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ValidatorCache(object):
+    """ Remembers the ETag/Last-Modified validators of fetched pages so
+        they can be requested conditionally. Along with the validators
+        the data parsed from the page is kept, so a 304 response needs
+        neither a transfer nor a re-parse.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.db.create("CREATE TABLE IF NOT EXISTS validators ("
+                       "url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, data TEXT)")
+
+    def lookup(self, url):
+        rows = self.db.query("SELECT etag, last_modified, data FROM validators WHERE url = ?", (url,))
+        if not rows:
+            return None
+        etag, last_modified, data = rows[0]
+        return CachedPage(etag, last_modified, json.loads(data))
+
+    def store(self, url, response, data):
+        """ saves the validators of response together with data, which
+            has to be JSON serializable
+        """
+        etag = response.headers.get('etag')
+        last_modified = response.headers.get('last-modified')
+        if response.status_code != 200 or not (etag or last_modified):
+            return
+        self.db.write("INSERT OR REPLACE INTO validators VALUES (?, ?, ?, ?)",
+                      (url, etag, last_modified, json.dumps(data)))
+
+
+class FileRecord(collections.namedtuple('FileRecord', 'size md5 mtime url')):
+    """ What the FileIndex knows about a mirrored file """
+    __slots__ = ()
+
+
+class FileIndex(object):
+    """ Size, md5, mtime and source url of every mirrored file, keyed by
+        package and filename. The skip-if-present checks ask the index
+        first, so an incremental run doesn't have to stat every file and
+        read its .md5 sidecar on the (possibly remote) mirror filesystem.
+        Files removed behind the mirror's back stay in the index until it
+        is rebuilt.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.db.create("CREATE TABLE IF NOT EXISTS files ("
+                       "package TEXT, filename TEXT, size INTEGER, md5 TEXT, "
+                       "mtime REAL, url TEXT, PRIMARY KEY (package, filename))")
+
+    def lookup(self, package, filename):
+        rows = self.db.query("SELECT size, md5, mtime, url FROM files "
+                             "WHERE package = ? AND filename = ?", (package, filename))
+        if not rows:
+            return None
+        return FileRecord(*rows[0])
+
+    def record(self, package, filename, size, md5=None, mtime=None, url=None):
+        self.db.write("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                      (package, filename, size, md5, mtime, url))
+
+    def remove(self, package, filename):
+        self.db.write("DELETE FROM files WHERE package = ? AND filename = ?", (package, filename))
+
+    def package_files(self, package):
+        """ returns {filename: FileRecord} for all files of package """
+        rows = self.db.query("SELECT filename, size, md5, mtime, url FROM files "
+                             "WHERE package = ?", (package,))
+        return dict((row[0], FileRecord(*row[1:])) for row in rows)
+
+    def clear(self, package=None):
+        if package is None:
+            self.db.write("DELETE FROM files")
+        else:
+            self.db.write("DELETE FROM files WHERE package = ?", (package,))
+
+
+class DescriptionIndex(object):
+    """ The short description of every package, taken from the newest
+        DOAP record saved for it. index_expanded.html is written from
+        here instead of globbing, stat-ing and parsing the DOAP files of
+        every package directory.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.db.create("CREATE TABLE IF NOT EXISTS descriptions ("
+                       "package TEXT PRIMARY KEY, doap TEXT, shortdesc TEXT)")
+
+    def lookup(self, package):
+        """ returns the short description ("" if there is none) or None
+            if the package isn't indexed yet
+        """
+        rows = self.db.query("SELECT shortdesc FROM descriptions WHERE package = ?", (package,))
+        if not rows:
+            return None
+        return rows[0][0] or ""
+
+    def store(self, package, doap, shortdesc):
+        """ doap is the filename of the DOAP record shortdesc came from """
+        if isinstance(shortdesc, unicode):
+            shortdesc = shortdesc.encode('utf-8')
+        self.db.write("INSERT OR REPLACE INTO descriptions VALUES (?, ?, ?)",
+                      (package, doap, shortdesc))
+
+
+class HeadRecord(collections.namedtuple('HeadRecord', 'final_url filename content_length status')):
+    """ What the HeadCache knows about a url. final_url and filename are
+        None if the url's redirects weren't resolved yet ("" if they led
+        nowhere), content_length is None if it wasn't probed.
+    """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.status == 200
+
+
+class HeadCache(object):
+    """ Outcomes of the HEAD requests sent to resolve download redirects
+        and to probe content lengths, so that a later run doesn't send
+        them again. Entries of successful requests are used for ttl
+        seconds; failures (an error status or no response at all) are
+        remembered as negative entries for negative_ttl seconds.
+    """
+    def __init__(self, db, ttl=7 * 86400, negative_ttl=6 * 3600):
+        self.db = db
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.db.create("CREATE TABLE IF NOT EXISTS heads ("
+                       "url TEXT PRIMARY KEY, final_url TEXT, filename TEXT, "
+                       "content_length INTEGER, status INTEGER, checked REAL)")
+
+    def lookup(self, url):
+        """ returns the fresh HeadRecord of url or None """
+        now = time.time()
+        rows = self.db.query("SELECT final_url, filename, content_length, status FROM heads "
+                             "WHERE url = ? AND checked >= "
+                             "CASE WHEN status = 200 THEN ? ELSE ? END",
+                             (url, now - self.ttl, now - self.negative_ttl))
+        if not rows:
+            return None
+        return HeadRecord(*rows[0])
+
+    def _row(self, url, now):
+        self.db.write("INSERT OR IGNORE INTO heads (url, checked) VALUES (?, ?)", (url, now))
+
+    def store_resolution(self, url, final_url, filename, status):
+        """ final_url and filename are None if the redirects led nowhere """
+        now = time.time()
+        self._row(url, now)
+        self.db.write("UPDATE heads SET final_url = ?, filename = ?, status = ?, checked = ? "
+                      "WHERE url = ?", (final_url or "", filename or "", status, now, url))
+
+    def store_length(self, url, content_length, status):
+        now = time.time()
+        self._row(url, now)
+        self.db.write("UPDATE heads SET content_length = ?, status = ?, checked = ? "
+                      "WHERE url = ?", (content_length, status, now, url))
+
+    def purge(self):
+        """ drops the entries too old to be used """
+        self.db.write("DELETE FROM heads WHERE checked < ?",
+                      (time.time() - max(self.ttl, self.negative_ttl),))
+        self.db.commit()
@@ -1,10 +1,20 @@
 import os
+import re
 import sys
 import time
 import datetime
+import bz2
+import collections
+import io
+import multiprocessing
+import optparse
+import struct
 import tarfile
 import gzip
 import zipfile
+import zlib
+
+from statedb import StateDB
 
 only_test_validity_of_archive = False
 
@@ -38,6 +48,11 @@ def splitext(path):
 
 
 def touch_file(file_name, mod_time):
+    """ returns False if the archive couldn't be read (mod_time is None)
+        or touched
+    """
+    if mod_time is None:
+        return False
     try:
         if not only_test_validity_of_archive :
             if mod_time > 0 and mod_time < 1609376461:
@@ -45,66 +60,268 @@ def touch_file(file_name, mod_time):
         #else:
         #    open("file_errors.txt", 'a').writelines(file_name+ ' has invalid datetime in file\n')
     except:
-        pass
+        return False
+    return True
+
+
+def _tar_mode(file_name):
+    # A plain tar is opened for random access, so the member data is
+    # seeked over instead of read. Compressed tars can't be seeked in,
+    # so they are read as a stream which never goes back and stops at
+    # the end-of-archive marker.
+    if file_name.lower().endswith('.tar'):
+        return 'r:'
+    return 'r|*'
 
 
 def get_time_for_tarfile(file_name):
     newest_time = 0
     try:
-        with tarfile.TarFile.open(file_name, 'r') as tarredFile:
-            members = tarredFile.getmembers()
-            if not only_test_validity_of_archive :
-                for member in members:
-                    if member.mtime > newest_time:
-                        newest_time = member.mtime
+        with tarfile.open(file_name, _tar_mode(file_name)) as tarredFile:
+            for member in tarredFile:
+                if only_test_validity_of_archive:
+                    continue
+                if member.mtime > newest_time:
+                    newest_time = member.mtime
     except:
         open("file_errors.txt", 'a').writelines(file_name+'\n')
+        return None
     return newest_time
     
 def get_time_for_zipfile(file_name):
+    # ZipFile only reads the central directory at the end of the archive,
+    # none of the member data is touched
     newest_time = 0
     try:
         with zipfile.ZipFile(file_name, 'r') as zippedFile:
             members = zippedFile.infolist()
-            if not only_test_validity_of_archive :
-                for member in members:
-                    #print member.orig_filename            
-                    curDT = time.mktime(datetime.datetime(*member.date_time).timetuple())
-                    if curDT > newest_time:
-                        newest_time = curDT
+            if not only_test_validity_of_archive and members:
+                newest = max(member.date_time for member in members)
+                newest_time = time.mktime(datetime.datetime(*newest).timetuple())
     except:
         open("file_errors.txt", 'a').writelines(file_name + '\n')
+        return None
     return newest_time
 
 
+DECOMPRESS_STEP = 256 * 1024
+
+class _TarHeaders(object):
+    """ Collects the newest member mtime from the tar headers going past
+        in a stream of (uncompressed) tar data. Member data is counted
+        but never kept.
+    """
+    _pax_types = (tarfile.XHDTYPE, tarfile.XGLTYPE, tarfile.SOLARIS_XHDTYPE)
+    _gnu_types = (tarfile.GNUTYPE_LONGNAME, tarfile.GNUTYPE_LONGLINK)
+
+    def __init__(self):
+        self.newest_time = 0
+        self.members = 0
+        self.done = False
+        self._buffer = ''
+        self._skip = 0
+        self._pax_type = None
+        self._pax_data = None
+        self._pax_size = 0
+        self._global_pax = {}
+        self._next_pax = {}
+
+    def feed(self, data):
+        while data and not self.done:
+            if self._skip:
+                taken = min(self._skip, len(data))
+                if self._pax_data is not None:
+                    self._pax_data.append(data[:taken])
+                self._skip -= taken
+                data = data[taken:]
+                if not self._skip and self._pax_data is not None:
+                    self._end_pax()
+                continue
+            needed = tarfile.BLOCKSIZE - len(self._buffer)
+            self._buffer += data[:needed]
+            data = data[needed:]
+            if len(self._buffer) == tarfile.BLOCKSIZE:
+                block, self._buffer = self._buffer, ''
+                self._header(block)
+
+    def _header(self, block):
+        if block == tarfile.NUL * tarfile.BLOCKSIZE:
+            if not self.members:
+                raise tarfile.ReadError("empty file")
+            self.done = True
+            return
+        if tarfile.nti(block[148:156]) not in tarfile.calc_chksums(block):
+            raise tarfile.ReadError("bad checksum")
+        size = tarfile.nti(block[124:136])
+        type = block[156]
+        self._skip = (size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+        if type in self._pax_types:
+            self._pax_type = type
+            self._pax_data = []
+            self._pax_size = size
+            if not self._skip:
+                self._end_pax()
+            return
+        if type in self._gnu_types:
+            return
+        mtime = tarfile.nti(block[136:148])
+        pax = self._next_pax
+        self._next_pax = {}
+        if 'mtime' in pax:
+            mtime = pax['mtime']
+        elif 'mtime' in self._global_pax:
+            mtime = self._global_pax['mtime']
+        self.members += 1
+        if mtime > self.newest_time:
+            self.newest_time = mtime
+
+    def _end_pax(self):
+        headers = _pax_headers(''.join(self._pax_data)[:self._pax_size])
+        if self._pax_type == tarfile.XGLTYPE:
+            self._global_pax.update(headers)
+        else:
+            self._next_pax = headers
+        self._pax_data = None
+
+
+_pax_record_regex = re.compile(r"(\d+) ([^=]+)=")
+
+def _pax_headers(data):
+    headers = {}
+    pos = 0
+    while pos < len(data):
+        match = _pax_record_regex.match(data, pos)
+        if not match:
+            raise tarfile.ReadError("invalid pax header")
+        length = int(match.group(1))
+        if match.group(2) == 'mtime':
+            headers['mtime'] = float(data[match.end():pos + length - 1])
+        pos += length
+    return headers
+
+
+class ArchiveTimer(object):
+    """ Works out the mtime of the newest archive member from the bytes of
+        the archive while they are downloaded, the way process_file would
+        from the finished file: tar headers are picked up as they go past
+        (decompressing .tar.gz/.tar.bz2 on the fly and stopping at the
+        end-of-archive marker) and the zip central directory is read from
+        the tail of the stream. Feed it with update() like a hashlib
+        object.
+    """
+    zip_tail_size = 1024 * 1024
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.failed = False
+        self._tar = None
+        self._decompressor = None
+        self._tail = collections.deque()
+        self._tail_size = 0
+        if kind in ('.tar', '.tar.gz', '.tar.bz2'):
+            self._tar = _TarHeaders()
+            self._decompressor = self._new_decompressor()
+
+    def _new_decompressor(self):
+        if self.kind == '.tar.gz':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if self.kind == '.tar.bz2':
+            return bz2.BZ2Decompressor()
+        return None
+
+    def update(self, chunk):
+        if self.failed:
+            return
+        try:
+            if self._tar is not None:
+                self._update_tar(chunk)
+            else:
+                self._update_zip(chunk)
+        except (tarfile.TarError, zlib.error, IOError, EOFError, ValueError):
+            self.failed = True
+
+    def _update_tar(self, chunk):
+        if self._tar.done:
+            return
+        if self._decompressor is None:
+            self._tar.feed(chunk)
+        elif self.kind == '.tar.gz':
+            while chunk and not self._tar.done:
+                # bounded steps, a run of zeros may inflate enormously
+                self._tar.feed(self._decompressor.decompress(chunk, DECOMPRESS_STEP))
+                chunk = self._decompressor.unconsumed_tail
+                if not chunk and self._decompressor.unused_data:
+                    # a gzip file made of several members
+                    chunk = self._decompressor.unused_data
+                    self._decompressor = self._new_decompressor()
+        else:
+            self._tar.feed(self._decompressor.decompress(chunk))
+
+    def _update_zip(self, chunk):
+        self._tail.append(chunk)
+        self._tail_size += len(chunk)
+        while self._tail_size - len(self._tail[0]) >= self.zip_tail_size:
+            self._tail_size -= len(self._tail.popleft())
+
+    def newest_time(self):
+        """ returns the newest member mtime or None if it couldn't be
+            determined from the stream
+        """
+        if self.failed:
+            return None
+        if self._tar is not None:
+            if not self._tar.done:
+                return None
+            return self._tar.newest_time
+        try:
+            with zipfile.ZipFile(io.BytesIO(''.join(self._tail)), 'r') as zippedFile:
+                members = zippedFile.infolist()
+                if not members:
+                    return 0
+                newest = max(member.date_time for member in members)
+                return time.mktime(datetime.datetime(*newest).timetuple())
+        except (zipfile.BadZipfile, zipfile.LargeZipFile, ValueError, IOError, struct.error):
+            # e.g. the central directory didn't fit into the tail
+            return None
+
+_archive_kinds = {'.zip': '.zip', '.whl': '.zip', '.egg': '.zip',
+                  '.tar': '.tar', '.tar.gz': '.tar.gz', '.tar.bz2': '.tar.bz2'}
+
+def archive_timer(filename):
+    """ returns an ArchiveTimer for filename or None if process_file
+        wouldn't touch it
+    """
+    kind = _archive_kinds.get(splitext(filename)[1].lower())
+    if kind is None:
+        return None
+    return ArchiveTimer(kind)
+
+
 def process_file(filename_to_process, verbose):
+    """ re-touches an archive. Returns True if it was read and touched,
+        False if it failed or isn't an archive.
+    """
     if os.path.getsize(filename_to_process) > 0:
         filename, file_extension = splitext(filename_to_process)
         for case in switch(file_extension.lower()):
             if case('.zip'):
                 if verbose: print "    " + filename_to_process
-                touch_file(filename_to_process, get_time_for_zipfile(filename_to_process))
-                break
+                return touch_file(filename_to_process, get_time_for_zipfile(filename_to_process))
             if case('.whl'):
                 if verbose: print "    " + filename_to_process
-                touch_file(filename_to_process, get_time_for_zipfile(filename_to_process))
-                break
+                return touch_file(filename_to_process, get_time_for_zipfile(filename_to_process))
             if case('.egg'):
                 if verbose: print "    " + filename_to_process
-                touch_file(filename_to_process, get_time_for_zipfile(filename_to_process))
-                break
+                return touch_file(filename_to_process, get_time_for_zipfile(filename_to_process))
             if case('.tar'):
                 if verbose: print "    " + filename_to_process
-                touch_file(filename_to_process, get_time_for_tarfile(filename_to_process))
-                break
+                return touch_file(filename_to_process, get_time_for_tarfile(filename_to_process))
             if case('.tar.gz'):
                 if verbose: print "    " + filename_to_process
-                touch_file(filename_to_process, get_time_for_tarfile(filename_to_process))
-                break
+                return touch_file(filename_to_process, get_time_for_tarfile(filename_to_process))
             if case('.tar.bz2'):
                 if verbose: print "    " + filename_to_process
-                touch_file(filename_to_process, get_time_for_tarfile(filename_to_process))
-                break
+                return touch_file(filename_to_process, get_time_for_tarfile(filename_to_process))
             if case(''):
                 break
             if case('.html'):
@@ -121,18 +338,117 @@ def process_file(filename_to_process, verbose):
                 print "Extension '" + file_extension.lower() + "' not handled."
     else:
         open("file_errors.txt", 'a').writelines('(empty file) ' + filename_to_process + '\n')
-        
+    return False
 
 
-def main(root_path):
+class StampRecord(object):
+    """ Size and mtime of every file as it was left by the last re-touch,
+        keyed by its path relative to the mirror root. A file whose size
+        and mtime still match has been stamped already and is skipped.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.db.create("CREATE TABLE IF NOT EXISTS stamps ("
+                       "path TEXT PRIMARY KEY, size INTEGER, mtime REAL)")
+
+    def directory(self, directory):
+        """ returns {filename: (size, mtime)} of the files recorded
+            directly in directory (a path relative to the mirror root), in
+            one range query over the primary key
+        """
+        prefix = os.path.join(directory, '') if directory not in ('', '.') else ''
+        if prefix:
+            # the paths starting with prefix sort below prefix with its
+            # separator replaced by the next character
+            rows = self.db.query("SELECT path, size, mtime FROM stamps WHERE path >= ? AND path < ?",
+                                 (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)))
+        else:
+            rows = self.db.query("SELECT path, size, mtime FROM stamps")
+        stamps = {}
+        for path, size, mtime in rows:
+            filename = path[len(prefix):]
+            if os.sep not in filename:
+                stamps[filename] = (size, mtime)
+        return stamps
+
+    def record(self, path, size, mtime):
+        self.db.write("INSERT OR REPLACE INTO stamps VALUES (?, ?, ?)", (path, size, mtime))
+
+
+def _unstamped_files(root_path, record):
+    """ yields the archives below root_path the record doesn't hold as
+        they are now. The record is read once per directory, and only
+        for directories with archives in them.
+    """
     for root, dirs, files in os.walk(root_path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
         print 'Processing Path ' + root
-        for file in files:
-            process_file(root + "/" + file, False)
-    print "\nStephen's Archive Re-Touch Utility Complete\n"
+        archives = [file for file in files
+                    if not file.startswith('.') and splitext(file)[1].lower() in _archive_kinds]
+        if not archives:
+            continue
+        stamps = record.directory(os.path.relpath(root, root_path))
+        for file in archives:
+            path = os.path.join(root, file)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if stamps.get(file) != (stat.st_size, stat.st_mtime):
+                yield path
+
+
+def _stamp(path):
+    """ runs in a pool process: re-touches path and returns what it looks
+        like afterwards, or None for size and mtime if that failed
+    """
+    try:
+        if not process_file(path, False):
+            return path, None, None
+        stat = os.stat(path)
+    except OSError:
+        return path, None, None
+    return path, stat.st_size, stat.st_mtime
 
 
+def main(root_path, processes=None, record_filename=None):
+    """ re-touches every archive below root_path which hasn't been stamped
+        yet, spread over processes worker processes (one per core by
+        default)
+    """
+    if record_filename is None:
+        record_filename = os.path.join(root_path, '.touch_archives.db')
+    record = StampRecord(StateDB(record_filename, commit_every=1000))
+    pool = multiprocessing.Pool(processes)
+    stamped = 0
+    try:
+        for path, size, mtime in pool.imap_unordered(_stamp, _unstamped_files(root_path, record), 16):
+            if size is not None:
+                record.record(os.path.relpath(path, root_path), size, mtime)
+                stamped += 1
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        record.db.close()
+    print "\n%d files stamped" % stamped
+    print "\nStephen's Archive Re-Touch Utility Complete\n"
 
 
 if __name__ == "__main__":
-    main(root_path='/Volumes/Python')
+    parser = optparse.OptionParser(usage="usage: %prog [options] [mirror path]")
+    parser.add_option('-p', '--processes', dest='processes', type='int', default=None,
+                      help='Number of worker processes (default: number of cores)')
+    parser.add_option('-r', '--record', dest='record', action='store', default=None,
+                      help='Stamp record database (default: <mirror path>/.touch_archives.db)')
+    parser.add_option('-a', '--all', dest='all', action='store_true', default=False,
+                      help='Forget the stamp record and re-touch every file')
+    options, args = parser.parse_args()
+    root_path = args[0] if args else '/Volumes/Python'
+    if options.all:
+        record_filename = options.record or os.path.join(root_path, '.touch_archives.db')
+        if os.path.exists(record_filename):
+            os.remove(record_filename)
+    main(root_path=root_path, processes=options.processes, record_filename=options.record)
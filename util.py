@@ -6,6 +6,11 @@
 # Published under the Zope Public License 2.1
 ################################################################
 
+import fnmatch
+import re
+
+_wildcards = re.compile(r'[*?[]')
+
 def isASCII(s):
     """ Checks if a string/unicode string contains only ASCII chars.  """
 
@@ -24,4 +29,61 @@ def isASCII(s):
             return False
 
     else:
-        raise TypeError('isASCII() requires a string or unicode string')
\ No newline at end of file
+        raise TypeError('isASCII() requires a string or unicode string')
+
+class PatternMatcher(object):
+    """ A list of glob patterns (package_matches or filename_matches)
+        compiled once.
+
+        match() does what fnmatch does for each pattern. The common forms
+        "*.ext" and "prefix*" are checked with str.endswith/startswith,
+        everything else with one combined regular expression. match_url()
+        also accepts urls where the pattern is followed by a query string,
+        the way Package.matches always did.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        prefixes = []
+        suffixes = []
+        globs = []
+        queries = []
+        for pattern in self.patterns:
+            if pattern.startswith('*') and not _wildcards.search(pattern[1:]):
+                suffixes.append(pattern[1:])
+            elif pattern.endswith('*') and not _wildcards.search(pattern[:-1]):
+                prefixes.append(pattern[:-1])
+            else:
+                regex = fnmatch.translate(pattern)
+                if regex.endswith('\\Z(?ms)'):
+                    regex = regex[:-len('\\Z(?ms)')]
+                globs.append('(?:%s)' % regex)
+            query = r'\\%s\?' % pattern
+            try:
+                re.compile(query)
+            except re.error:
+                # not usable as a regular expression, glob matching only
+                continue
+            queries.append('(?:%s)' % query)
+        self._prefixes = tuple(prefixes)
+        self._suffixes = tuple(suffixes)
+        self._glob = re.compile('(?ms)(?:%s)\\Z' % '|'.join(globs)) if globs else None
+        self._query = re.compile('|'.join(queries)) if queries else None
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def __iter__(self):
+        return iter(self.patterns)
+
+    def match(self, name):
+        if name.endswith(self._suffixes) or name.startswith(self._prefixes):
+            return True
+        return self._glob is not None and self._glob.match(name) is not None
+
+    def match_url(self, url):
+        if self.match(url):
+            return True
+        # perhaps the filename is part of a query string; all query
+        # expressions end in a literal "?"
+        return self._query is not None and '?' in url and self._query.search(url) is not None